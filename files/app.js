@@ -18,3 +18,70 @@
  * under the License.
  *
  */
+
+"use strict";
+
+// Offer completions from /suggest as the user types in a search box
+
+(function () {
+    var input = document.querySelector("#query input");
+
+    if (!input) {
+        return;
+    }
+
+    var list = document.createElement("datalist");
+    var timer = null;
+    var current = null;
+
+    list.id = "query-suggestions";
+
+    input.parentNode.appendChild(list);
+    input.setAttribute("list", list.id);
+    input.setAttribute("autocomplete", "off");
+
+    function show(suggestions) {
+        while (list.firstChild) {
+            list.removeChild(list.firstChild);
+        }
+
+        suggestions.forEach(function (suggestion) {
+            var option = document.createElement("option");
+            option.value = suggestion;
+            list.appendChild(option);
+        });
+    }
+
+    function update() {
+        var query = input.value;
+
+        if (query === current) {
+            return;
+        }
+
+        current = query;
+
+        if (query.trim().length < 2) {
+            show([]);
+            return;
+        }
+
+        var request = new XMLHttpRequest();
+
+        request.open("GET", "/suggest?query=" + encodeURIComponent(query));
+        request.responseType = "json";
+
+        request.onload = function () {
+            if (request.status === 200 && request.response && input.value === query) {
+                show(request.response.suggestions);
+            }
+        };
+
+        request.send();
+    }
+
+    input.addEventListener("input", function () {
+        clearTimeout(timer);
+        timer = setTimeout(update, 100);
+    });
+})();
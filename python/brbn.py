@@ -17,12 +17,18 @@
 # under the License.
 #
 
+import cProfile as _cProfile
+import collections as _collections
 import datetime as _datetime
 import functools as _functools
 import hashlib as _hashlib
+import hmac as _hmac
+import io as _io
+import json as _json
 import logging as _logging
 import os as _os
 import pprint as _pprint
+import pstats as _pstats
 import re as _re
 import sched as _sched
 import sys as _sys
@@ -32,15 +38,20 @@ import traceback as _traceback
 import urllib as _urllib
 import uuid as _uuid
 
+from escaping import xml_escape
+from escaping import xml_unescape
 from tornado.httpserver import HTTPServer as _HTTPServer
 from tornado.ioloop import IOLoop as _IOLoop
+from tornado.netutil import bind_sockets as _bind_sockets
+from tornado.process import fork_processes as _fork_processes
 from tornado.wsgi import WSGIContainer as _WSGIContainer
+from urllib.parse import quote as _url_path_escape
 from urllib.parse import quote_plus as _url_escape
 from urllib.parse import unquote_plus as _url_unescape
-from xml.sax.saxutils import escape as _xml_escape
-from xml.sax.saxutils import unescape as _xml_unescape
 
 _log = _logging.getLogger("brbn")
+_slow_log = _logging.getLogger("brbn.slow")
+_access_log = _logging.getLogger("brbn.access")
 
 _xhtml = "application/xhtml+xml; charset=utf-8"
 _text = "text/plain"
@@ -65,9 +76,10 @@ _page_template = """<!DOCTYPE html>
     <title>{title}</title>
     <meta charset="utf-8"/>
     <meta name="viewport" content="width=device-width, initial-scale=1.0"/>
-    <link rel="stylesheet" href="/app.css" type="text/css"/>
+    <link rel="stylesheet" href="{brbn_stylesheet_href}" type="text/css"/>
+    <link rel="stylesheet" href="{stylesheet_href}" type="text/css"/>
     <link rel="icon" href="" type="image/png"/>
-    <script src="/app.js" type="application/javascript" defer="defer"></script>
+    <script src="{script_href}" type="application/javascript" defer="defer"></script>
   </head>
   <body>
     <div id="-head">
@@ -105,27 +117,20 @@ def url_unescape(string):
 
     return _url_unescape(string)
 
-_extra_entities = {
-    '"': "&quot;",
-    "'": "&#x27;",
-    "/": "&#x2F;",
-}
-
 def xml(meth):
     meth._xml = True
     return meth
-    
-def xml_escape(string):
-    if string is None:
-        return
 
-    return _xml_escape(string, _extra_entities)
+_path_slashes_regex = _re.compile(r"//+")
 
-def xml_unescape(string):
-    if string is None:
-        return
+def normalize_path(path):
+    if "//" in path:
+        path = _path_slashes_regex.sub("/", path)
+
+    if len(path) > 1 and path.endswith("/"):
+        path = path[:-1]
 
-    return _xml_unescape(string)
+    return path
 
 def compute_etag(content):
     return _hashlib.sha1(content).hexdigest()[:8]
@@ -148,15 +153,31 @@ class Application:
         self._brbn_home = None
 
         self._resources = dict()
+        self._routes = list()
+
+        # Fingerprinted path -> file.  These are consulted only when
+        # routing, so each file is loaded and listed once.
+        self._file_aliases = dict()
 
         self._root_resource = None
         self._error_page = _ErrorPage(self)
 
         self._sessions_by_id = dict()
-        self._session_expire_thread = _SessionExpireThread(self)
+        self._session_expire_thread = None
+        self._started_pid = None
 
         self.debug = "BRBN_DEBUG" in _os.environ
 
+        self._metrics = None
+        self._profiler = None
+
+        # Requests taking at least this many seconds are logged with
+        # their phase timings; None disables the check
+        self.slow_request_threshold = None
+
+        # Write one JSON line per request to the brbn.access log
+        self.access_logging = False
+
     def __repr__(self):
         return _format_repr(self, self.home)
 
@@ -184,7 +205,23 @@ class Application:
     def root_resource(self, resource):
         assert isinstance(resource, Resource), resource
         self._root_resource = resource
+
+    @property
+    def metrics(self):
+        return self._metrics
+
+    @property
+    def profiler(self):
+        return self._profiler
     
+    def enable_metrics(self, path="/metrics"):
+        self._metrics = Metrics()
+        _MetricsPage(self, path)
+
+    def enable_profiling(self, token, path="/profile"):
+        self._profiler = Profiler(self, token, path)
+        _ProfilerPage(self, path)
+
     def load(self):
         _log.info("Loading {}".format(self))
 
@@ -224,29 +261,112 @@ class Application:
 
         if self.root_resource is None:
             raise Error("I can't find a root resource")
-                
+
+        self._routes = list()
+
         for path, resource in sorted(self.resources.items()):
+            if resource._route is not None and path == resource.path:
+                self._routes.append(resource._route)
+
             resource.init()
 
+    # Server.run calls start in each server process, after forking,
+    # since threads don't survive a fork.  An embedder that also calls
+    # it first is harmless: it runs once per process.
+
     def start(self):
+        if self._started_pid == _os.getpid():
+            return
+
+        self._started_pid = _os.getpid()
+
         _log.info("Starting {}".format(self))
+
+        self._session_expire_thread = _SessionExpireThread(self)
         self._session_expire_thread.start()
 
     def __call__(self, env, start_response):
+        if self.profiler is not None and self.profiler.is_requested(env):
+            return self.profiler.profile_call(env, start_response)
+
+        return self._call(env, start_response)
+
+    def _call(self, env, start_response):
         request = Request(self, env, start_response)
 
         try:
-            return self._do_call(request)
+            response = self._do_call(request)
         except Exception as e:
             _log.exception("Unexpected error")
-            return request.respond_unexpected_error(e)
+            response = request.respond_unexpected_error(e)
+
+        if self.metrics is not None:
+            self.metrics.record(request)
+
+        threshold = self.slow_request_threshold
+
+        if threshold is not None:
+            elapsed = request.elapsed_time
+
+            if elapsed >= threshold:
+                self._log_slow_request(request, elapsed)
+
+        if self.access_logging:
+            self._log_access(request)
+
+        return response
+
+    def _log_access(self, request):
+        timings = request.timings
+        status = request.status
+        now = _datetime.datetime.now(_datetime.timezone.utc)
+
+        if status is not None:
+            status = int(status.split(" ", 1)[0])
+
+        fields = {
+            "time": now.isoformat().replace("+00:00", "Z"),
+            "method": request.method,
+            "path": request.path,
+            "status": status,
+            "bytes": request.content_length,
+            "session_created": request._session_created,
+            "not_modified": status == 304,
+            "sql_count": request.timing_counts.get("sql", 0),
+            "sql_ms": round(timings.get("sql", 0) * 1000, 3),
+            "render_ms": round(timings.get("render", 0) * 1000, 3),
+            "total_ms": round(request.elapsed_time * 1000, 3),
+        }
+
+        _access_log.info(_json.dumps(fields, separators=(",", ":")))
+
+    def _log_slow_request(self, request, elapsed):
+        timings = list()
+
+        for name, seconds in sorted(request.timings.items()):
+            count = request.timing_counts[name]
+            timings.append("{}={:.3f}s/{}".format(name, seconds, count))
+
+        lines = [
+            "Slow request ({:.3f}s, {})".format(elapsed, request.status),
+            "  Request: {} {}".format(request.method, request.path),
+            "  Query: {}".format(request.env.get("QUERY_STRING", "")),
+            "  Resource: {}".format(request.resource),
+            "  Timings: {}".format(" ".join(timings)),
+        ]
+
+        _slow_log.warning("\n".join(lines))
 
     def _do_call(self, request):
+        start = _time.perf_counter()
+
         try:
             request.load()
         except _RequestError as e:
             _log.exception("Request error")
             return request.respond_error(e)
+        finally:
+            request.add_timing("load", _time.perf_counter() - start)
 
         _log.debug("Receiving {}".format(request))
 
@@ -257,15 +377,42 @@ class Application:
             return request.respond_error(e)
         
     def receive_request(self, request):
-        try:
-            resource = self.resources[request.path]
-        except KeyError:
+        resource = self.find_resource(request)
+
+        if resource is None:
             return request.respond_not_found()
 
         request._resource = resource
 
         return resource.receive_request(request)
 
+    def find_resource(self, request):
+        path = normalize_path(request.path)
+        resource = self.resources.get(path)
+
+        if resource is not None:
+            return resource
+
+        resource = self._file_aliases.get(path)
+
+        if resource is not None:
+            return resource
+
+        for route in self._routes:
+            path_parameters = route.match(path)
+
+            if path_parameters is not None:
+                request._path_parameters = path_parameters
+                return route.resource
+
+    def get_file_href(self, request, path):
+        resource = self.resources.get(path)
+
+        if resource is None:
+            return path
+
+        return resource.get_href(request)
+
 class Request:
     def __init__(self, app, env, start_response):
         self._app = app
@@ -273,12 +420,21 @@ class Request:
         self._start_response = start_response
 
         self._parameters = None
+        self._path_parameters = dict()
+        self._values = None
         self._response_headers = list()
 
         self._session = None
+        self._session_created = False
         self._resource = None
         self._object = None
 
+        self._start_time = _time.perf_counter()
+        self._timings = dict()
+        self._timing_counts = dict()
+        self._status = None
+        self._content_length = 0
+
     def __repr__(self):
         return _format_repr(self, self.path)
 
@@ -292,8 +448,18 @@ class Request:
 
     @property
     def parameters(self):
+        if self._parameters is None:
+            # Set this first so the error page can render the request
+            # if parsing fails
+            self._parameters = dict()
+            self._parameters = self._parse_query_string()
+
         return self._parameters
 
+    @property
+    def path_parameters(self):
+        return self._path_parameters
+
     @property
     def response_headers(self):
         return self._response_headers
@@ -314,18 +480,39 @@ class Request:
     def object(self, obj):
         self._object = obj
 
-    def load(self):
-        self._parameters = self._parse_query_string()
+    @property
+    def status(self):
+        return self._status
+
+    @property
+    def content_length(self):
+        return self._content_length
 
+    @property
+    def timings(self):
+        return self._timings
+
+    @property
+    def timing_counts(self):
+        return self._timing_counts
+
+    @property
+    def elapsed_time(self):
+        return _time.perf_counter() - self._start_time
+
+    def add_timing(self, name, seconds):
+        self._timings[name] = self._timings.get(name, 0) + seconds
+        self._timing_counts[name] = self._timing_counts.get(name, 0) + 1
+
+    def load(self):
         session_id = self._parse_session_cookie()
 
-        if session_id is None:
+        if session_id is not None:
+            self._session = self.app._sessions_by_id.get(session_id)
+
+        if self._session is None:
             self._session = Session(self.app)
-        else:
-            try:
-                self._session = self.app._sessions_by_id[session_id]
-            except KeyError:
-                self._session = Session(self.app)
+            self._session_created = True
 
         self.session._touched = _datetime.datetime.now()
 
@@ -345,6 +532,13 @@ class Request:
         if not query_string:
             return {}
 
+        # Our hrefs separate query variables with semicolons, which
+        # parse_qs no longer accepts
+        if isinstance(query_string, bytes):
+            query_string = query_string.replace(b";", b"&")
+        else:
+            query_string = query_string.replace(";", "&")
+
         try:
             return _urllib.parse.parse_qs(query_string, False, True)
         except ValueError:
@@ -373,20 +567,21 @@ class Request:
         return self.env["PATH_INFO"]
 
     def get(self, name, default=None):
-        try:
-            return self.parameters[name][0]
-        except KeyError:
-            return default
-        except IndexError:
-            return default
+        if self._values is None:
+            values = {k: v[0] for k, v in self.parameters.items() if v}
+            values.update(self.path_parameters)
+
+            self._values = values
+
+        return self._values.get(name, default)
 
     def require(self, name):
-        try:
-            return self.parameters[name][0]
-        except KeyError:
+        value = self.get(name)
+
+        if value is None:
             raise _RequestError("Parameter '{}' is missing".format(name))
-        except IndexError:
-            raise _RequestError("Parameter '{}' has no values".format(name))        
+
+        return value
         
     def is_modified(self, server_etag):
         client_etag = self.env.get("HTTP_IF_NONE_MATCH")
@@ -401,16 +596,32 @@ class Request:
         self.response_headers.append((name, str(value)))
     
     def respond(self, status, content=None, content_type=None):
+        start = _time.perf_counter()
+
+        try:
+            return self._respond(status, content, content_type)
+        finally:
+            self.add_timing("respond", _time.perf_counter() - start)
+
+    def _respond(self, status, content, content_type):
+        self._status = status
+
         csp = "default-src: 'self'"
         sts = "max-age=31536000"
 
         self.add_response_header("Content-Security-Policy", csp)
         self.add_response_header("Strict-Transport-Security", sts)
     
-        if self.session is not None:
+        # Only set the cookie when it changes, so responses for
+        # existing sessions remain cacheable
+
+        if self.session is not None and self._session_created:
             # value = "session={}; Path=/; Secure; HttpOnly".format(self.session._id)
             value = "session={}; Path=/; HttpOnly".format(self.session._id)
             self.add_response_header("Set-Cookie", value)
+
+            # A shared cache would replay the cookie to other clients
+            self._make_private()
         
         if content is None:
             self.add_response_header("Content-Length", 0)
@@ -424,6 +635,7 @@ class Request:
         assert content_type is not None
 
         content_length = len(content)
+        self._content_length = content_length
 
         self.add_response_header("Content-Length", content_length)
         self.add_response_header("Content-Type", content_type)
@@ -432,6 +644,29 @@ class Request:
 
         return (content,)
 
+    def _make_private(self):
+        headers = self.response_headers
+
+        for i, (name, value) in enumerate(headers):
+            if name != "Cache-Control" or "no-store" in value:
+                continue
+
+            if "public" in value:
+                value = value.replace("public", "private")
+            elif "private" not in value:
+                value = "private, {}".format(value)
+
+            headers[i] = name, value
+
+    # Drop caching headers set before a failure, so errors aren't
+    # cached or revalidated
+
+    def _make_uncacheable(self):
+        headers = [x for x in self.response_headers if x[0] not in ("Cache-Control", "ETag")]
+        headers.append(("Cache-Control", "no-store"))
+
+        self._response_headers = headers
+
     def respond_ok(self, content, content_type):
         return self.respond("200 OK", content, content_type)
     
@@ -474,16 +709,102 @@ class Request:
 
     def _respond_unexpected_error_fallback(self):
         content = _traceback.format_exc()
+
+        self._make_uncacheable()
+
         return self.respond("500 Internal Server Error", content, _text)
 
 class _RequestError(Exception):
     pass
 
+class _Route:
+    # kind -> (regex, converter)
+    _kinds = {
+        "str": (r"[^/]+", str),
+        "int": (r"[0-9]+", int),
+        "path": (r".+", str),
+    }
+
+    def __init__(self, resource, path):
+        self._resource = resource
+        self._path = path
+        self._tokens = list()
+        self._converters = dict()
+
+        pattern = list()
+
+        for token in _re.split("(<.+?>)", path):
+            if token.startswith("<") and token.endswith(">"):
+                name, sep, kind = token[1:-1].partition(":")
+
+                try:
+                    regex, converter = self._kinds[kind or "str"]
+                except KeyError:
+                    raise Error("Unknown parameter type '{}' in route '{}'"
+                                .format(kind, path))
+
+                pattern.append("(?P<{}>{})".format(name, regex))
+
+                self._tokens.append((name, kind))
+                self._converters[name] = converter
+            else:
+                pattern.append(_re.escape(token))
+
+                self._tokens.append(token)
+
+        self._regex = _re.compile("".join(pattern))
+
+    def __repr__(self):
+        return _format_repr(self, self._path)
+
+    @property
+    def resource(self):
+        return self._resource
+
+    def match(self, path):
+        m = self._regex.fullmatch(path)
+
+        if m is None:
+            return
+
+        values = dict()
+
+        for name, value in m.groupdict().items():
+            values[name] = self._converters[name](value)
+
+        return values
+
+    # -> path, remaining_params
+    def format(self, params):
+        params = dict(params)
+        out = list()
+
+        for token in self._tokens:
+            if isinstance(token, str):
+                out.append(token)
+                continue
+
+            name, kind = token
+
+            try:
+                value = params.pop(name)
+            except KeyError:
+                raise Error("Parameter '{}' is required for route '{}'"
+                            .format(name, self._path))
+
+            out.append(_url_path_escape(str(value), safe=""))
+
+        return "".join(out), params
+
 class Resource:
     def __init__(self, app, path):
         self._app = app
         self._path = path
         self._content_type = find_content_type(path)
+        self._route = None
+
+        if "<" in path:
+            self._route = _Route(self, path)
 
         self.app.resources[self.path] = self
 
@@ -511,17 +832,22 @@ class Resource:
         pass
 
     def get_href(self, request, **params):
+        path = self.path
+
+        if self._route is not None:
+            path, params = self._route.format(params)
+
         if not params:
-            return self.path
+            return path
         
         query_vars = list()
 
         for name, value in sorted(params.items()):
-            query_vars.append("{}={}".format(url_escape(name), url_escape(value)))
+            query_vars.append("{}={}".format(url_escape(name), url_escape(str(value))))
 
         query_vars = ";".join(query_vars)
 
-        return "{}?{}".format(self.path, query_vars)
+        return "{}?{}".format(path, query_vars)
 
     def get_title(self, request):
         return self.path
@@ -532,24 +858,51 @@ class Resource:
         
         return "<a href=\"{}\">{}</a>".format(href, xml_escape(title))
 
+    def get_cache_control(self, request):
+        pass
+
     def receive_request(self, request):
-        self.process(request)
+        start = _time.perf_counter()
+
+        try:
+            self.process(request)
+        finally:
+            request.add_timing("process", _time.perf_counter() - start)
+
         return self.send_response(request)
 
     def send_response(self, request):
         etag =  self.get_etag(request)
 
-        if etag is not None:
-            if not request.is_modified(etag):
-                return request.respond_not_modified()
-            
-            request.add_response_header("ETag", "\"{}\"".format(etag))
+        if etag is not None and not request.is_modified(etag):
+            self._add_caching_headers(request, etag)
+            return request.respond_not_modified()
+
+        start = _time.perf_counter()
+
+        try:
+            content = self.render(request)
+        finally:
+            request.add_timing("render", _time.perf_counter() - start)
+
+        # Only after a successful render, so an error page never goes
+        # out with this resource's caching headers
+
+        self._add_caching_headers(request, etag)
 
-        content = self.render(request)
         content_type = self.get_content_type(request)
         
         return request.respond_ok(content, content_type)
 
+    def _add_caching_headers(self, request, etag):
+        cache_control = self.get_cache_control(request)
+
+        if cache_control is not None:
+            request.add_response_header("Cache-Control", cache_control)
+
+        if etag is not None:
+            request.add_response_header("ETag", "\"{}\"".format(etag))
+
     def process(self, request):
         pass
     
@@ -563,10 +916,21 @@ class File(Resource):
         self._fs_path = fs_path
         self._content = None
         self._etag = None
+        self._fingerprint_path = None
+
+    @property
+    def fingerprint_path(self):
+        return self._fingerprint_path
 
     def get_etag(self, request):
         return self._etag
 
+    def get_href(self, request, **params):
+        if params or self.fingerprint_path is None:
+            return super().get_href(request, **params)
+
+        return self.fingerprint_path
+
     def load(self):
         super().load()
 
@@ -575,14 +939,30 @@ class File(Resource):
 
         self._etag = compute_etag(self._content)
 
+        # Serve the content at a second path containing the etag.
+        # The content behind that path never changes, so clients
+        # can cache it forever.
+
+        if self._fingerprint_path is not None:
+            self.app._file_aliases.pop(self._fingerprint_path, None)
+
+        name, ext = _os.path.splitext(self.path)
+
+        self._fingerprint_path = "{}.{}{}".format(name, self._etag, ext)
+        self.app._file_aliases[self._fingerprint_path] = self
+
+    def get_cache_control(self, request):
+        if self.app.debug:
+            return "max-age=0"
+
+        if request.path == self.fingerprint_path:
+            return "immutable, max-age=31536000"
+
+        return "max-age=120"
+
     def process(self, request):
-        max_age = 120
-        
         if self.app.debug:
             self.load()
-            max_age = 0
-        
-        request.add_response_header("Cache-Control", "max-age={}".format(max_age))
 
     def render(self, request):
         return self._content
@@ -616,6 +996,15 @@ class Page(Resource):
     def render_title(self, request):
         return self.get_title(request)
 
+    def render_brbn_stylesheet_href(self, request):
+        return self.app.get_file_href(request, "/brbn.css")
+
+    def render_stylesheet_href(self, request):
+        return self.app.get_file_href(request, "/app.css")
+
+    def render_script_href(self, request):
+        return self.app.get_file_href(request, "/app.js")
+
     @xml
     def render_path_navigation(self, request):
         links = self.get_path_links(request)
@@ -821,6 +1210,8 @@ class _ErrorPage(Page):
         status = request.error_status
         content = self.render(request)
         content_type = self.get_content_type(request)
+
+        request._make_uncacheable()
         
         return request.respond(status, content, content_type)
 
@@ -869,6 +1260,7 @@ class _RequestInfo(Template):
             ("request.method", request.method),
             ("request.path", request.path),
             ("request.parameters", request.parameters),
+            ("request.path_parameters", request.path_parameters),
             ("request.session", request.session),
             ("request.resource", request.resource),
             ("request.object", request.object),
@@ -900,6 +1292,342 @@ class _RequestInfo(Template):
 
         return self._render_attributes(attrs)
 
+class _MetricsPage(Resource):
+    def __init__(self, app, path):
+        super().__init__(app, path)
+
+        self._content_type = "text/plain; version=0.0.4; charset=utf-8"
+
+    def get_cache_control(self, request):
+        return "no-store"
+
+    def render(self, request):
+        return self.app.metrics.render()
+
+class Metrics:
+    buckets = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+               0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+    def __init__(self):
+        self._lock = _threading.Lock()
+
+        # (resource, status) -> count
+        self._requests = _collections.defaultdict(int)
+
+        # resource -> [bucket counts..., +Inf count, sum]
+        self._durations = dict()
+
+        # (resource, phase) -> [count, sum]
+        self._phases = dict()
+
+        # Values supplied by the application at render time
+        self._values = list()
+
+    def __repr__(self):
+        return _format_repr(self)
+
+    # Report the result of calling func as metric name.  Kind is
+    # "gauge" or "counter".
+
+    def add_value(self, name, help, func, kind="gauge"):
+        self._values.append((name, help, func, kind))
+
+    def record(self, request):
+        duration = request.elapsed_time
+
+        if request.resource is None:
+            resource = ""
+        else:
+            resource = request.resource.path
+
+        status = ""
+
+        if request.status is not None:
+            status = request.status.split(" ", 1)[0]
+
+        with self._lock:
+            self._requests[(resource, status)] += 1
+
+            try:
+                histogram = self._durations[resource]
+            except KeyError:
+                histogram = [0] * (len(self.buckets) + 2)
+                self._durations[resource] = histogram
+
+            for i, bound in enumerate(self.buckets):
+                if duration <= bound:
+                    histogram[i] += 1
+
+            histogram[-2] += 1
+            histogram[-1] += duration
+
+            for phase, seconds in request.timings.items():
+                key = resource, phase
+
+                try:
+                    summary = self._phases[key]
+                except KeyError:
+                    summary = [0, 0]
+                    self._phases[key] = summary
+
+                summary[0] += request.timing_counts[phase]
+                summary[1] += seconds
+
+    def render(self):
+        with self._lock:
+            requests = sorted(self._requests.items())
+            durations = sorted((k, list(v)) for k, v in self._durations.items())
+            phases = sorted((k, list(v)) for k, v in self._phases.items())
+
+        lines = list()
+
+        lines.append("# HELP brbn_requests_total Requests handled")
+        lines.append("# TYPE brbn_requests_total counter")
+
+        for (resource, status), count in requests:
+            labels = _format_labels(resource=resource, status=status)
+            lines.append("brbn_requests_total{} {}".format(labels, count))
+
+        lines.append("# HELP brbn_request_duration_seconds Request latency")
+        lines.append("# TYPE brbn_request_duration_seconds histogram")
+
+        for resource, histogram in durations:
+            name = "brbn_request_duration_seconds"
+
+            for bound, count in zip(self.buckets, histogram):
+                labels = _format_labels(resource=resource, le=repr(bound))
+                lines.append("{}_bucket{} {}".format(name, labels, count))
+
+            labels = _format_labels(resource=resource, le="+Inf")
+            lines.append("{}_bucket{} {}".format(name, labels, histogram[-2]))
+
+            labels = _format_labels(resource=resource)
+            lines.append("{}_sum{} {}".format(name, labels, histogram[-1]))
+            lines.append("{}_count{} {}".format(name, labels, histogram[-2]))
+
+        lines.append("# HELP brbn_request_phase_seconds Time spent per "
+                     "request phase")
+        lines.append("# TYPE brbn_request_phase_seconds summary")
+
+        for (resource, phase), (count, seconds) in phases:
+            name = "brbn_request_phase_seconds"
+            labels = _format_labels(resource=resource, phase=phase)
+
+            lines.append("{}_sum{} {}".format(name, labels, seconds))
+            lines.append("{}_count{} {}".format(name, labels, count))
+
+        for name, help, func, kind in self._values:
+            lines.append("# HELP {} {}".format(name, help))
+            lines.append("# TYPE {} {}".format(name, kind))
+            lines.append("{} {}".format(name, func()))
+
+        lines.append("")
+
+        return "\n".join(lines)
+
+def _format_labels(**labels):
+    items = list()
+
+    for name, value in sorted(labels.items()):
+        value = value.replace("\\", "\\\\").replace("\"", "\\\"")
+        items.append("{}=\"{}\"".format(name, value))
+
+    return "{{{}}}".format(",".join(items))
+
+class _ProfilerPage(Resource):
+    def __init__(self, app, path):
+        super().__init__(app, path)
+
+        self._content_type = "text/plain; charset=utf-8"
+
+    def get_cache_control(self, request):
+        return "no-store"
+
+    def receive_request(self, request):
+        profiler = self.app.profiler
+
+        if not profiler.is_authorized(request.env, request.get("token")):
+            return request.respond("403 Forbidden", "Forbidden\n", _text)
+
+        # The sampling interval is kept between a millisecond, below
+        # which sampling starves the request threads, and a second
+
+        try:
+            interval = float(request.get("interval", 0.005))
+        except ValueError:
+            return request.respond("400 Bad Request", "Bad interval\n", _text)
+
+        request.interval = min(1.0, max(0.001, interval))
+
+        return super().receive_request(request)
+
+    def process(self, request):
+        action = request.get("action", "status")
+        profiler = self.app.profiler
+
+        if action == "start":
+            profiler.start_sampler(request.interval)
+        elif action == "stop":
+            profiler.stop_sampler()
+        elif action not in ("status", "stacks"):
+            raise _RequestError("Unknown profiler action '{}'".format(action))
+
+    def render(self, request):
+        profiler = self.app.profiler
+
+        if request.get("action") == "stacks":
+            return profiler.render_stacks()
+
+        return "Sampler running: {}\nSamples: {}\n".format \
+            (profiler.sampler_running, profiler.sample_count)
+
+# Admin-only profiling.  A request carrying the token in the
+# X-Brbn-Profile header or the 'profile' parameter is run under
+# cProfile, and the response is replaced by the profile report.  The
+# stack sampler is started and stopped through the profiler page, and
+# it produces collapsed stacks for flame graph tools.
+
+class Profiler:
+    def __init__(self, app, token, path):
+        assert token
+
+        self._app = app
+        self._token = token.encode("utf-8")
+        self._path = path
+        self._sampler = None
+        self._stacks = _collections.Counter()
+        self._lock = _threading.Lock()
+
+    def __repr__(self):
+        return _format_repr(self, self._app)
+
+    @property
+    def sampler_running(self):
+        return self._sampler is not None
+
+    @property
+    def sample_count(self):
+        with self._lock:
+            return sum(self._stacks.values())
+
+    def is_authorized(self, env, token=None):
+        if token is None:
+            token = env.get("HTTP_X_BRBN_PROFILE")
+
+        if token is None:
+            return False
+
+        return _hmac.compare_digest(token.encode("utf-8"), self._token)
+
+    def is_requested(self, env):
+        if env["PATH_INFO"] == self._path:
+            return False
+
+        token = env.get("HTTP_X_BRBN_PROFILE")
+
+        if token is None and "profile=" in env.get("QUERY_STRING", ""):
+            query_string = env["QUERY_STRING"].replace(";", "&")
+            query_vars = _urllib.parse.parse_qs(query_string)
+            token = query_vars.get("profile", [None])[0]
+
+        return token is not None and self.is_authorized(env, token)
+
+    def profile_call(self, env, start_response):
+        statuses = list()
+
+        def capture_response(status, headers, exc_info=None):
+            statuses.append(status)
+
+        profile = _cProfile.Profile()
+        profile.runcall(self._app._call, env, capture_response)
+
+        out = _io.StringIO()
+        stats = _pstats.Stats(profile, stream=out)
+        stats.sort_stats("cumulative").print_stats(60)
+
+        content = "Profile of {} {} ({})\n{}".format \
+            (env["REQUEST_METHOD"], env["PATH_INFO"], statuses[0], out.getvalue())
+        content = content.encode("utf-8")
+
+        headers = [
+            ("Content-Type", "text/plain; charset=utf-8"),
+            ("Content-Length", str(len(content))),
+            ("Cache-Control", "no-store"),
+        ]
+
+        start_response("200 OK", headers)
+
+        return (content,)
+
+    def start_sampler(self, interval=0.005):
+        if self._sampler is not None:
+            return
+
+        _log.info("Starting stack sampler at {}s intervals".format(interval))
+
+        with self._lock:
+            self._stacks.clear()
+
+        self._sampler = _StackSamplerThread(self, interval)
+        self._sampler.start()
+
+    def stop_sampler(self):
+        if self._sampler is None:
+            return
+
+        _log.info("Stopping stack sampler")
+
+        self._sampler.stop()
+        self._sampler = None
+
+    def render_stacks(self):
+        with self._lock:
+            stacks = sorted(self._stacks.items())
+
+        lines = ["{} {}".format(stack, count) for stack, count in stacks]
+        lines.append("")
+
+        return "\n".join(lines)
+
+    def _add_sample(self, stack):
+        with self._lock:
+            self._stacks[stack] += 1
+
+class _StackSamplerThread(_threading.Thread):
+    def __init__(self, profiler, interval):
+        super().__init__()
+
+        self.profiler = profiler
+        self.interval = interval
+        self.daemon = True
+        self.stopping = _threading.Event()
+
+    def stop(self):
+        self.stopping.set()
+        self.join()
+
+    def run(self):
+        ident = _threading.get_ident()
+
+        while not self.stopping.wait(self.interval):
+            for thread_id, frame in _sys._current_frames().items():
+                if thread_id == ident:
+                    continue
+
+                self.profiler._add_sample(self._collapse(frame))
+
+    def _collapse(self, frame):
+        names = list()
+
+        while frame is not None:
+            module = frame.f_globals.get("__name__", "?")
+            names.append("{}:{}".format(module, frame.f_code.co_name))
+            frame = frame.f_back
+
+        names.reverse()
+
+        return ";".join(names)
+
 class Session:
     def __init__(self, app):
         self._app = app
@@ -947,11 +1675,29 @@ class _SessionExpireThread(_threading.Thread):
         _log.debug("Expired {} client sessions".format(count))
         
 class Server:
-    def __init__(self, app, port=8000):
+    def __init__(self, app, port=8000, address=None, backlog=128,
+                 processes=1, reuse_port=False, keep_alive=True,
+                 idle_timeout=3600, body_timeout=None, max_body_size=None,
+                 decompress=False):
         self._app = app
         self._port = port
 
-        self._tornado_server = _HTTPServer(_WSGIContainer(self._app))
+        # Socket settings
+        self.address = address
+        self.backlog = backlog
+        self.reuse_port = reuse_port
+
+        # Number of server processes; 0 means one per CPU
+        self.processes = processes
+
+        # Connection settings; None means the Tornado default
+        self.keep_alive = keep_alive
+        self.idle_timeout = idle_timeout
+        self.body_timeout = body_timeout
+        self.max_body_size = max_body_size
+        self.decompress = decompress
+
+        self._tornado_server = None
 
     def __repr__(self):
         return _format_repr(self, self._app, self._port)
@@ -959,14 +1705,41 @@ class Server:
     def run(self):
         _log.info("Starting {}".format(self))
 
+        # With reuse_port, each process binds its own listening socket
+        # and the kernel balances connections across them.  Otherwise
+        # the processes share one socket bound before forking.
+
+        if self.processes != 1 and self.reuse_port:
+            _fork_processes(self.processes)
+
+        sockets = self._bind()
+
+        if self.processes != 1 and not self.reuse_port:
+            _fork_processes(self.processes)
+
+        self._app.start()
+
+        self._tornado_server = _HTTPServer \
+            (_WSGIContainer(self._app),
+             no_keep_alive=not self.keep_alive,
+             idle_connection_timeout=self.idle_timeout,
+             body_timeout=self.body_timeout,
+             max_body_size=self.max_body_size,
+             decompress_request=self.decompress)
+
+        self._tornado_server.add_sockets(sockets)
+
+        _IOLoop.current().start()
+
+    def _bind(self):
         try:
-            self._tornado_server.listen(self._port)
-        except OSError as e:
+            return _bind_sockets(self._port, self.address,
+                                 backlog=self.backlog,
+                                 reuse_port=self.reuse_port)
+        except (OSError, ValueError) as e:
             msg = "Cannot listen on port {}: {}".format(self._port, str(e))
             raise Error(msg)
 
-        _IOLoop.instance().start()
-
 class Hello(Application):
     def __init__(self, home):
         super().__init__(home)
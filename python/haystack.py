@@ -17,23 +17,38 @@
 # under the License.
 #
 
+import array as _array
+import bisect as _bisect
 import brbn
+import calendar as _calendar
+import collections as _collections
 import email.utils as _email
+import heapq as _heapq
 import json as _json
 import logging as _logging
 import os as _os
 import quopri as _quopri
 import re as _re
 import sqlite3 as _sqlite
+import sys as _sys
+import threading as _threading
 import time as _time
 import textwrap as _textwrap
 
 from datetime import datetime as _datetime
 from pencil import *
+from searching import QueryError
+from searching import compile_query
+from searching import parse_query
 
 _log = _logging.getLogger("haystack")
+_slow_log = _logging.getLogger("haystack.slow")
 _strings = StringCatalog(__file__)
 _topics = _json.loads(_strings["topics"])
+_strings_digest = brbn.compute_etag(_json.dumps(sorted(_strings.items())).encode("utf-8"))
+
+# Archived messages change only when the data is reimported
+_object_cache_control = "public, max-age=3600"
 
 class Haystack(brbn.Application):
     def __init__(self, home_dir):
@@ -46,14 +61,38 @@ class Haystack(brbn.Application):
         self.search_page = _SearchPage(self)
         self.thread_page = _ThreadPage(self)
         self.message_page = _MessagePage(self)
+        self.sender_page = _SenderPage(self)
+        self.browse_page = _BrowsePage(self)
+        self.browse_month_page = _BrowseMonthPage(self)
+        self.suggest_resource = _SuggestResource(self)
+
+    def enable_metrics(self, path="/metrics"):
+        super().enable_metrics(path)
+
+        self._add_cache_metrics("object", self.database.object_cache)
+        self._add_cache_metrics("search", self.database.search_cache)
+
+    def _add_cache_metrics(self, name, cache):
+        prefix = "haystack_{}_cache".format(name)
+        metrics = self.metrics
+
+        metrics.add_value("{}_hits_total".format(prefix),
+                          "{} cache hits".format(name.capitalize()),
+                          lambda: cache.hits, "counter")
+        metrics.add_value("{}_misses_total".format(prefix),
+                          "{} cache misses".format(name.capitalize()),
+                          lambda: cache.misses, "counter")
+        metrics.add_value("{}_bytes".format(prefix),
+                          "Estimated {} cache size".format(name),
+                          lambda: cache.size)
 
     def receive_request(self, request):
-        request.database_connection = self.database.connect()
+        request.database_connection = self.database.acquire()
 
         try:
             return super().receive_request(request)
         finally:
-            request.database_connection.close()
+            self.database.release(request.database_connection)
 
 class _IndexPage(brbn.Page):
     def __init__(self, app):
@@ -62,325 +101,1786 @@ class _IndexPage(brbn.Page):
     def get_title(self, request):
         return "Haystack"
 
-    @brbn.xml
-    def render_topics(self, request):
-        items = list()
+    @brbn.xml
+    def render_topics(self, request):
+        items = list()
+
+        for topic in _topics:
+            href = self.app.search_page.get_href(request, query=topic)
+            text = xml_escape(topic)
+
+            items.append(html_a(text, href))
+
+        return html_ul(items, class_="four-column")
+
+    @brbn.xml
+    def render_senders(self, request):
+        items = list()
+
+        for sender in self.app.database.get_top_senders(request):
+            text = xml_escape("{} ({})".format(sender.address, sender.message_count))
+            href = self.app.sender_page.get_href(request, id=sender.id)
+
+            items.append(html_a(text, href))
+
+        return html_ul(items, class_="three-column")
+
+class _SearchPage(brbn.Page):
+    page_size = 100
+
+    def __init__(self, app):
+        super().__init__(app, "/search", _strings["search_page_body"])
+
+    def get_title(self, request):
+        query = request.get("query")
+        return "Search '{}'".format(query)
+
+    # The matching thread IDs come from the search cache, so paging
+    # through the results runs the full text query only once
+
+    def process(self, request):
+        query = request.get("query", "")
+        request.page = _get_page_number(request)
+        request.thread_count = 0
+        request.threads = ()
+        request.results = None
+        request.query_error = None
+
+        if not query.strip():
+            return
+
+        try:
+            request.results = self.app.database.search(request, query)
+        except QueryError as e:
+            request.query_error = str(e)
+            return
+
+        rowids = request.results.rowids
+        offset = (request.page - 1) * self.page_size
+
+        request.thread_count = len(rowids)
+        request.threads = self.app.database.get_threads \
+            (request, rowids[offset:offset + self.page_size])
+
+    def render_query(self, request):
+        return request.get("query")
+
+    @brbn.xml
+    def render_threads(self, request):
+        if request.query_error is not None:
+            return html_p(xml_escape(request.query_error), class_="error")
+
+        rows = list()
+
+        for thread in request.threads:
+            row = [
+                thread.get_link(request),
+                self.app.sender_page.get_link_to(request, thread.from_address),
+                thread.authored_words,
+                xml_escape(str(_email.formatdate(thread.date)[:-6])),
+            ]
+
+            rows.append(row)
+
+        return html_table(rows, False, class_="messages four")
+
+    # Each facet value links to the current query narrowed by it
+
+    @brbn.xml
+    def render_facets(self, request):
+        results = request.results
+
+        if results is None or not results.rowids:
+            return
+
+        query = request.get("query")
+        sections = list()
+
+        # Counts from a cut match set are lower bounds
+        plus = "+" if results.truncated else ""
+
+        facets = (
+            ("Lists", "list", [(x.strip("<>"), n) for x, n in results.lists if x]),
+            ("Senders", "from", results.senders),
+            ("Years", "date", results.years),
+        )
+
+        for title, field, counts in facets:
+            items = list()
+
+            for value, count in counts:
+                value = str(value or "").replace("\"", "")
+
+                if not value:
+                    continue
+
+                # The query is grouped so the filter applies to all of it
+                narrowed = "({}) {}:\"{}\"".format(query, field, value)
+                href = self.get_href(request, query=narrowed)
+                text = "{} ({}{})".format(xml_escape(value), count, plus)
+
+                items.append(html_a(text, href))
+
+            sections.append(html_div(html_h(title) + html_ul(items)))
+
+        return html_div("".join(sections), class_="facets three-column")
+
+    @brbn.xml
+    def render_pages(self, request):
+        query = request.get("query")
+
+        def get_href(page):
+            return self.get_href(request, query=query, page=page)
+
+        return _render_pages(request, request.thread_count, self.page_size, get_href)
+
+class _SenderPage(brbn.ObjectPage):
+    page_size = 100
+
+    def __init__(self, app):
+        super().__init__(app, "/sender/<id:path>", _strings["sender_page_body"])
+
+    def get_cache_control(self, request):
+        return _object_cache_control
+
+    def get_object(self, request):
+        id = request.get("id")
+        request.page = _get_page_number(request)
+
+        return self.app.database.get(request, Sender, id)
+
+    def get_title(self, request):
+        return "Sender '{}'".format(request.object.name)
+
+    def process(self, request):
+        offset = (request.page - 1) * self.page_size
+
+        request.messages = self.app.database.get_sender_messages \
+            (request, request.object, offset, self.page_size)
+
+    def render_title(self, request):
+        return request.object.name
+
+    # -> escaped link to the sender page for address
+    def get_link_to(self, request, address, text=None):
+        if text is None:
+            text = address
+
+        if address is None:
+            return xml_escape(text)
+
+        return html_a(xml_escape(text), self.get_href(request, id=address))
+
+    def render_summary(self, request):
+        sender = request.object
+        first = _time.strftime("%d %b %Y", _time.gmtime(sender.first_date))
+        last = _time.strftime("%d %b %Y", _time.gmtime(sender.last_date))
+
+        return "{} messages from {} to {}".format(sender.message_count, first, last)
+
+    @brbn.xml
+    def render_messages(self, request):
+        rows = list()
+
+        for message in request.messages:
+            row = [
+                message.get_link(request),
+                message.authored_words,
+                xml_escape(str(_email.formatdate(message.date)[:-6])),
+            ]
+
+            rows.append(row)
+
+        return html_table(rows, False, class_="messages")
+
+    @brbn.xml
+    def render_pages(self, request):
+        sender = request.object
+
+        def get_href(page):
+            return self.get_href(request, id=sender.id, page=page)
+
+        return _render_pages(request, sender.message_count, self.page_size, get_href)
+
+class _SuggestResource(brbn.Resource):
+    def __init__(self, app):
+        super().__init__(app, "/suggest")
+
+        self._content_type = "application/json; charset=utf-8"
+
+    # Called after render.  Suggestions from an index still being
+    # rebuilt aren't worth caching.
+
+    def get_cache_control(self, request):
+        if getattr(request, "stale_suggestions", False):
+            return "no-cache"
+
+        return _object_cache_control
+
+    def render(self, request):
+        query = request.get("query", "")
+        suggestions = self.app.database.get_suggestions(request, query)
+
+        return _json.dumps({"query": query, "suggestions": suggestions})
+
+class _ThreadPage(brbn.ObjectPage):
+    page_size = 500
+
+    def __init__(self, app):
+        super().__init__(app, "/thread/<id:path>", _strings["thread_page_body"])
+
+    def get_cache_control(self, request):
+        return _object_cache_control
+
+    def get_object(self, request):
+        id = request.get("id")
+        request.page = _get_page_number(request)
+
+        offset = (request.page - 1) * self.page_size
+
+        return self.app.database.get_thread(request, id, offset, self.page_size)
+
+    def get_title(self, request):
+        return "Thread '{}'".format(request.object.subject)
+
+    # Render both sections in one pass over the thread.  Every message
+    # appears in the index; only those on the current page carry
+    # content.
+
+    def process(self, request):
+        thread = request.object
+        rows = list()
+        out = list()
+
+        for entry in thread.entries:
+            number = str(entry.number)
+            title = xml_escape(entry.title)
+
+            if entry.on_page:
+                href = "#{}".format(number)
+
+                # Older databases may not have the content rendered yet
+                if entry.rendered_content is None:
+                    content = render_message_content(entry.content)
+                else:
+                    content = entry.rendered_content
+
+                out.append(html_elem("h2", title, id=number))
+                out.append(html_elem("pre", content))
+            else:
+                page = (entry.number - 1) // self.page_size + 1
+                href = "{}#{}".format(self.get_href(request, id=thread.id, page=page),
+                                      number)
+
+            date = _time.strftime("%d %b %Y", _time.gmtime(entry.date))
+
+            rows.append([html_a(title, href), date, entry.authored_words])
+
+        request.index = html_table(rows, False, class_="messages")
+        request.messages = "\n".join(out)
+
+    def render_title(self, request):
+        return request.object.subject
+
+    @brbn.xml
+    def render_pages(self, request):
+        thread = request.object
+
+        def get_href(page):
+            return self.get_href(request, id=thread.id, page=page)
+
+        return _render_pages(request, len(thread.entries), self.page_size, get_href)
+
+    @brbn.xml
+    def render_index(self, request):
+        return request.index
+
+    @brbn.xml
+    def render_messages(self, request):
+        return request.messages
+
+class _BrowsePage(brbn.Page):
+    def __init__(self, app):
+        super().__init__(app, "/browse", _strings["browse_page_body"])
+
+    def get_cache_control(self, request):
+        return _object_cache_control
+
+    def get_etag(self, request):
+        return _get_page_etag(self, request)
+
+    def get_title(self, request):
+        return "Browse"
+
+    @brbn.xml
+    def render_lists(self, request):
+        months = dict()
+        lists = list()
+
+        for list_month in self.app.database.get_list_months(request):
+            if list_month.list_name not in lists:
+                lists.append(list_month.list_name)
+
+            months[(list_month.list_name, list_month.month)] = list_month
+
+        month_names = [_calendar.month_abbr[x] for x in range(1, 13)]
+        out = list()
+
+        for list_name in lists:
+            years = sorted(set(int(m[:4]) for l, m in months if l == list_name), reverse=True)
+            rows = [[""] + month_names]
+
+            for year in years:
+                row = [str(year)]
+
+                for month in range(1, 13):
+                    list_month = months.get((list_name, "{}-{:02}".format(year, month)))
+
+                    if list_month is None:
+                        row.append("")
+                        continue
+
+                    href = self.app.browse_month_page.get_href \
+                        (request, list=list_name, month=list_month.month)
+
+                    row.append(html_a(str(list_month.thread_count), href))
+
+                rows.append(row)
+
+            out.append(html_elem("h2", xml_escape(list_name)))
+            out.append(html_table(rows, True, True, class_="months"))
+
+        return "\n".join(out)
+
+# Past months never change, so their pages are cached for a day and
+# then revalidated by ETag
+
+class _BrowseMonthPage(brbn.ObjectPage):
+    page_size = 100
+
+    def __init__(self, app):
+        super().__init__(app, "/browse/<list>/<month>", _strings["browse_month_page_body"])
+
+    def get_cache_control(self, request):
+        if request.object.date_range[1] < _time.time():
+            return "public, max-age=86400"
+
+        return _object_cache_control
+
+    # The page changes only when the month's counts do, so new mail in
+    # other months leaves its ETag alone
+
+    def get_etag(self, request):
+        list_month = request.object
+        generation = getattr(request.database_connection, "generation", 0)
+        data_key = generation, list_month.thread_count, list_month.message_count
+
+        return _get_page_etag(self, request, data_key)
+
+    def get_object(self, request):
+        list_id = "<{}>".format(request.get("list"))
+        return self.app.database.get_list_month(request, list_id, request.get("month"))
+
+    def get_title(self, request):
+        return request.object.name
+
+    # The page key is the date and ID of the last thread on the
+    # previous page.  A missing or malformed key means the first page.
+
+    def process(self, request):
+        request.before = None
+
+        before = request.get("before")
+        before_id = request.get("before_id")
+
+        if before is None or before_id is None:
+            return
+
+        try:
+            request.before = int(before), before_id
+        except ValueError:
+            pass
+
+    # Threads are loaded at render time, after the ETag check, so a
+    # revalidated page costs one small query
+
+    def render_title(self, request):
+        return request.object.name
+
+    def render_summary(self, request):
+        list_month = request.object
+        return "{} threads, {} messages".format(list_month.thread_count,
+                                                list_month.message_count)
+
+    @brbn.xml
+    def render_threads(self, request):
+        threads = self.app.database.get_list_threads \
+            (request, request.object, request.before, self.page_size + 1)
+
+        request.more_threads = len(threads) > self.page_size
+        request.threads = threads[:self.page_size]
+
+        rows = list()
+
+        for thread in request.threads:
+            date = _time.strftime("%d %b %Y", _time.gmtime(thread.date))
+            rows.append([thread.get_link(request), xml_escape(thread.from_name),
+                         thread.message_count, date])
+
+        return html_table(rows, False, class_="messages four")
+
+    @brbn.xml
+    def render_pages(self, request):
+        list_month = request.object
+        links = list()
+
+        if request.before is not None:
+            href = self.get_href(request, list=list_month.list_name, month=list_month.month)
+            links.append(html_a("Newest", href))
+
+        if request.more_threads:
+            last = request.threads[-1]
+            href = self.get_href(request, list=list_month.list_name, month=list_month.month,
+                                 before=last.date, before_id=last.id)
+            links.append(html_a("Older", href))
+
+        if links:
+            return html_p(" ".join(links))
+
+# A strong ETag for pages that change only with the data.  It covers
+# the data version, or a narrower data_key from the page, the request,
+# the page strings, and the file fingerprints in the page head.
+
+def _get_page_etag(page, request, data_key=None):
+    if data_key is None:
+        data_key = page.app.database.get_data_version(request)
+
+    key = [
+        str(data_key),
+        request.path,
+        request.env.get("QUERY_STRING", ""),
+        _strings_digest,
+        page.render_brbn_stylesheet_href(request),
+        page.render_stylesheet_href(request),
+        page.render_script_href(request),
+    ]
+
+    return brbn.compute_etag("\n".join(key).encode("utf-8"))
+
+def _get_page_number(request):
+    try:
+        return max(1, int(request.get("page", 1)))
+    except ValueError:
+        return 1
+
+def _render_pages(request, item_count, page_size, get_href):
+    count = (item_count - 1) // page_size + 1
+
+    if count <= 1:
+        return
+
+    items = list()
+
+    for page in range(1, count + 1):
+        if page == request.page:
+            items.append(str(page))
+        else:
+            items.append(html_a(str(page), get_href(page)))
+
+    return html_p("Pages: {}".format(" ".join(items)))
+
+class _MessagePage(brbn.ObjectPage):
+    def __init__(self, app):
+        super().__init__(app, "/message/<id:path>", _strings["message_page_body"])
+
+    def get_cache_control(self, request):
+        return _object_cache_control
+
+    # The thread root and the parent come back in the same query as
+    # the message, so the links below cost nothing more
+
+    def get_object(self, request):
+        id = request.get("id")
+
+        return self.app.database.get_with_references \
+            (request, Message, id, "thread_id", "in_reply_to_id")
+
+    def get_title(self, request):
+        return "Message '{}'".format(request.message.subject)
+
+    def process(self, request):
+        request.message = request.object
+
+    def render_title(self, request):
+        return request.message.subject
+
+    @brbn.xml
+    def render_thread_link(self, request):
+        return self._render_message_link(request, request.message.thread_id)
+
+    @brbn.xml
+    def render_in_reply_to_link(self, request):
+        rmessage_id = request.message.in_reply_to_id
+
+        if rmessage_id is None:
+            return "[None]"
+
+        return self._render_message_link(request, rmessage_id)
+
+    def _render_message_link(self, request, id):
+        if id is None:
+            return xml_escape(id)
+
+        try:
+            message = self.app.database.get(request, Message, id)
+        except ObjectNotFound:
+            return xml_escape(id)
+
+        return message.get_link(request)
+
+    @brbn.xml
+    def render_headers(self, request):
+        message = request.message
+        from_field = "{} <{}>".format(message.from_name, message.from_address)
+        from_link = self.app.sender_page.get_link_to(request, message.from_address,
+                                                     from_field)
+
+        items = (
+            ("ID", xml_escape(message.id)),
+            ("List", xml_escape(message.list_id)),
+            ("From", from_link),
+            ("Date", xml_escape(_email.formatdate(message.date))),
+            ("Subject", xml_escape(message.subject)),
+        )
+
+        return html_table(items, False, True, class_="headers")
+
+    @brbn.xml
+    def render_content(self, request):
+        message = request.message
+
+        # Older databases may not have the content rendered yet
+        if message.rendered_content is None:
+            return render_message_content(message.content)
+
+        return message.rendered_content
+
+_indexes = (
+    ("messages_id_idx", "messages", "id"),
+    ("messages_thread_idx", "messages", "thread_id, thread_position, date"),
+    ("messages_sender_idx", "messages", "from_address, date"),
+    ("senders_count_idx", "senders", "message_count"),
+    ("list_threads_idx", "list_threads", "list_id, date, id"),
+    ("list_threads_id_idx", "list_threads", "id"),
+)
+
+# Tables derived from the messages.  senders has one row per sender
+# address and is kept up to date by Message.save.  list_threads and
+# list_months index threads by list and month of their first message;
+# they are rebuilt by Database.update_thread_index after an import and
+# updated by Database.update_threads during live ingestion.
+
+_derived_tables = (
+    ("create table if not exists senders "
+     "(id text primary key, from_name text, message_count integer, "
+     "first_date integer, last_date integer)"),
+    ("create table if not exists list_threads "
+     "(id text, list_id text, month text, date integer, subject text, "
+     "from_name text, message_count integer)"),
+    ("create table if not exists list_months "
+     "(list_id text, month text, thread_count integer, message_count integer, "
+     "primary key (list_id, month))"),
+)
+
+_list_threads_select = (
+    "select r.id, r.list_id, strftime('%Y-%m', r.date, 'unixepoch'), r.date, "
+    "r.subject, r.from_name, count(*) "
+    "from messages as r "
+    "join messages as m on m.thread_id = r.id "
+    "where r.id = r.thread_id"
+)
+
+_query_operators = (b"AND", b"OR", b"NOT", b"NEAR")
+_word_re = _re.compile(r"[^\W_]+")
+
+# The database file may be a symlink to a numbered generation, such as
+# data.sqlite -> data-7.sqlite.  The importer builds each new
+# generation beside the current one and swaps the symlink atomically.
+# Each connection opens whatever generation is current when it is
+# made, so requests in flight finish on the old file while new ones
+# use the new file.  The previous generation is kept until the next
+# import, for any readers still draining.
+
+_generation_re = _re.compile(r"-(\d+)\.sqlite$")
+
+class _Connection(_sqlite.Connection):
+    generation = 0
+    identity = None
+    _database = None
+
+    def close(self):
+        database, self._database = self._database, None
+
+        if database is not None:
+            database._release_generation(self.generation)
+
+        super().close()
+
+class Database:
+    def __init__(self, path):
+        self.path = path
+
+        # (file identity, generation number) of the current generation
+        self._current = None
+
+        # Generation number -> count of open connections
+        self._connection_counts = _collections.Counter()
+        self._connection_lock = _threading.Lock()
+
+        # Reader connections kept open between requests
+        self.max_idle_connections = 8
+        self._idle_connections = list()
+
+        # Queries taking at least this many seconds are logged with
+        # their query plan; None disables the check
+        self.slow_query_threshold = None
+
+        # Objects shared by all requests until the data version changes
+        self.object_cache = ObjectCache("object")
+
+        # Thread IDs matching recent searches
+        self.search_cache = ObjectCache("search", 16 * 1024 * 1024)
+
+        # Built on first use and again when the data version changes
+        self._suggestion_index = None
+        self._suggestion_builder = None
+        self._suggestion_lock = _threading.Lock()
+
+        _log.info("Using database at {}".format(self.path))
+
+    @property
+    def generation(self):
+        return self._find_generation()[1]
+
+    def connect(self):
+        file, generation = self._find_generation()
+
+        with self._connection_lock:
+            self._connection_counts[generation] += 1
+
+        try:
+            conn = _sqlite.connect(file, factory=_Connection)
+        except:
+            self._release_generation(generation)
+            raise
+
+        conn.generation = generation
+        conn.identity = self._current[0]
+        conn._database = self
+
+        return conn
+
+    # Reader connections for requests.  A connection returned by
+    # release is reused by the next acquire if it is still on the
+    # current generation.  Reads don't hold a transaction open between
+    # statements, so an idle connection pins no snapshot and doesn't
+    # keep a WAL checkpoint from completing.
+
+    def acquire(self):
+        self._find_generation()
+
+        identity = self._current[0]
+
+        with self._connection_lock:
+            idle = [x for x in self._idle_connections if x.identity == identity]
+            stale = [x for x in self._idle_connections if x.identity != identity]
+            conn = idle.pop() if idle else None
+
+            self._idle_connections = idle
+
+        for x in stale:
+            x.close()
+
+        if conn is None:
+            conn = self.connect()
+
+        return conn
+
+    def release(self, conn):
+        if not conn.in_transaction and conn.identity == self._current[0]:
+            with self._connection_lock:
+                if len(self._idle_connections) < self.max_idle_connections:
+                    self._idle_connections.append(conn)
+                    return
+
+        conn.close()
+
+    # -> real file, generation number.  This costs a couple of stat
+    # calls, cheap enough to do for every connection.
+
+    def _find_generation(self):
+        file = _os.path.realpath(self.path)
+
+        try:
+            st = _os.stat(file)
+            identity = file, st.st_dev, st.st_ino
+        except FileNotFoundError:
+            identity = file, None, None
+
+        current = self._current
+
+        if current is not None and current[0] == identity:
+            return file, current[1]
+
+        match = _generation_re.search(file)
+        generation = int(match.group(1)) if match else 0
+
+        if current is not None and current[0][2] is not None:
+            _log.info("Switching to database generation {} at {}".format(generation, file))
+
+        self._current = identity, generation
+
+        return file, generation
+
+    def _release_generation(self, generation):
+        with self._connection_lock:
+            self._connection_counts[generation] -= 1
+
+            if self._connection_counts[generation] > 0:
+                return
+
+            del self._connection_counts[generation]
+
+        current = self._current
+
+        if current is not None and generation != current[1]:
+            _log.info("Database generation {} drained".format(generation))
+
+    # -> path of a new generation beside the current one, for the
+    # importer to build
+
+    def get_next_generation_path(self):
+        dir, name = _os.path.split(_os.path.abspath(self.path))
+        stem = _os.path.splitext(name)[0]
+        numbers = [self._find_generation()[1]]
+
+        for file in _os.listdir(dir):
+            match = _generation_re.search(file)
+
+            if match is not None and file.startswith(stem + "-"):
+                numbers.append(int(match.group(1)))
+
+        return _os.path.join(dir, "{}-{}.sqlite".format(stem, max(numbers) + 1))
+
+    # Make the generation at path current by swapping the symlink.
+    # Generations older than the one replaced are removed.
+
+    def publish_generation(self, path):
+        dir = _os.path.dirname(_os.path.abspath(self.path))
+        previous = _os.path.realpath(self.path)
+        temp = "{}.{}.tmp".format(_os.path.abspath(self.path), _os.getpid())
+
+        _os.symlink(_os.path.relpath(path, dir), temp)
+        _os.replace(temp, self.path)
+
+        _log.info("Published database generation at {}".format(path))
+
+        keep = {_os.path.realpath(path), previous}
+        stem = _os.path.splitext(_os.path.basename(self.path))[0]
+
+        for file in _os.listdir(dir):
+            file = _os.path.join(dir, file)
+
+            if not _os.path.basename(file).startswith(stem + "-"):
+                continue
+
+            if _generation_re.search(file) is None or file in keep:
+                continue
+
+            _log.info("Removing old database generation at {}".format(file))
+
+            for suffix in ("", "-journal", "-wal", "-shm"):
+                if _os.path.exists(file + suffix):
+                    _os.remove(file + suffix)
+
+    def create_schema(self):
+        columns = [_column_definition(x) for x in Message.fields]
+
+        # Optimizing the search index frees the pages of the segments
+        # it merged.  Incremental vacuum returns them without a full
+        # VACUUM, which would renumber the messages rowids the index
+        # refers to.
+
+        statements = ["pragma auto_vacuum = incremental"]
+
+        columns = ", ".join(columns)
+        ddl = "create table messages ({});".format(columns)
+        statements.append(ddl)
+        statements.extend(_derived_tables)
+
+        for name, table, columns in _indexes:
+            ddl = "create index {} on {} ({});".format(name, table, columns)
+            statements.append(ddl)
+
+        statements.extend(_fts_schema())
+
+        conn = self.connect()
+        cursor = conn.cursor()
+
+        try:
+            for statement in statements:
+                cursor.execute(statement)
+        finally:
+            conn.close()
+
+    # Bring a database created by an older version up to date.  New
+    # columns are added empty and filled in by scripts/upgrade-data.
+    # An FTS4 search index is replaced with FTS5 and rebuilt in one
+    # transaction; for a large archive, reimporting avoids the stall.
+
+    def upgrade_schema(self):
+        conn = self.connect()
+        cursor = conn.cursor()
+
+        try:
+            cursor.execute("pragma table_info(messages)")
+            existing = set(x[1] for x in cursor.fetchall())
+
+            for name in Message.fields:
+                if name in existing:
+                    continue
+
+                _log.info("Adding column {}".format(name))
+
+                ddl = "alter table messages add column {}"
+                cursor.execute(ddl.format(_column_definition(name)))
+
+            for ddl in _derived_tables:
+                cursor.execute(ddl)
+
+            for name, table, columns in _indexes:
+                ddl = "create index if not exists {} on {} ({})"
+                cursor.execute(ddl.format(name, table, columns))
+
+            cursor.execute("select sql from sqlite_master where name = 'messages_fts'")
+            record = cursor.fetchone()
+
+            if record is None or "using fts5" not in record[0].lower():
+                _log.info("Rebuilding the search index with FTS5")
+
+                cursor.execute("drop table if exists messages_fts")
+
+                for ddl in _fts_schema():
+                    cursor.execute(ddl)
+
+                cursor.execute("insert into messages_fts (messages_fts) values ('rebuild')")
+
+            conn.commit()
+        finally:
+            conn.close()
+
+    # Recompute the sender statistics from the messages.  The importer
+    # keeps them current as it goes; this is for older databases.
+
+    def update_senders(self):
+        conn = self.connect()
+        cursor = conn.cursor()
+
+        try:
+            cursor.execute("delete from senders")
+            cursor.execute("insert into senders "
+                           "select from_address, max(from_name), count(*), "
+                           "min(date), max(date) from messages "
+                           "where from_address is not null "
+                           "group by from_address")
+            conn.commit()
+        finally:
+            conn.close()
+
+    # Rebuild the per-list, per-month thread index behind the browse
+    # pages.  Each thread is filed under the list and month of its
+    # first message.
+
+    def update_thread_index(self):
+        conn = self.connect()
+        cursor = conn.cursor()
+
+        try:
+            cursor.execute("delete from list_threads")
+            cursor.execute("insert into list_threads {} group by r.id"
+                           "".format(_list_threads_select))
+            cursor.execute("delete from list_months")
+            cursor.execute("insert into list_months "
+                           "select list_id, month, count(*), sum(message_count) "
+                           "from list_threads group by list_id, month")
+            conn.commit()
+        finally:
+            conn.close()
+
+    # Refresh the thread index entries of the given threads in the
+    # caller's transaction
+
+    def update_threads(self, cursor, thread_ids):
+        thread_ids = list(thread_ids)
+        marks = ", ".join("?" * len(thread_ids))
+
+        cursor.execute("delete from list_threads where id in ({})".format(marks),
+                       thread_ids)
+        cursor.execute("insert into list_threads {} and r.id in ({}) group by r.id"
+                       "".format(_list_threads_select, marks), thread_ids)
+        cursor.execute("select distinct list_id, month from list_threads "
+                       "where id in ({})".format(marks), thread_ids)
+
+        for list_id, month in cursor.fetchall():
+            cursor.execute("insert or replace into list_months "
+                           "select list_id, month, count(*), sum(message_count) "
+                           "from list_threads where list_id = ? and month = ?",
+                           [list_id, month])
+
+    # Add new messages in the caller's transaction, as live ingestion
+    # does.  Messages already stored are skipped.  A message without
+    # thread information joins the thread of its parent if the parent
+    # is stored.  -> number of messages added
+
+    def append_messages(self, cursor, messages):
+        thread_ids = set()
+        count = 0
+
+        for message in messages:
+            cursor.execute("select 1 from messages where id = ?", [message.id])
+
+            if cursor.fetchone() is not None:
+                continue
+
+            if message.thread_id is None:
+                message.thread_id = message.id
+                message.thread_position = 0
+
+                cursor.execute("select thread_id, thread_position from messages "
+                               "where id = ?", [message.in_reply_to_id])
+                record = cursor.fetchone()
+
+                if record is not None:
+                    message.thread_id = record[0]
+                    message.thread_position = record[1] + 1
+
+            message.save(cursor)
+
+            thread_ids.add(message.thread_id)
+            count += 1
+
+        if thread_ids:
+            self.update_threads(cursor, thread_ids)
+
+        return count
+
+    # Live ingestion runs the database in WAL mode, so readers keep
+    # serving from their snapshot while the writer commits.  The mode
+    # is stored in the file and applies to every later connection.
+    # -> the journal mode in effect
+
+    def enable_wal(self):
+        conn = self.connect()
+        cursor = conn.cursor()
+
+        try:
+            cursor.execute("pragma journal_mode = wal")
+            return cursor.fetchone()[0]
+        finally:
+            conn.close()
+
+    # Copy committed pages from the WAL back into the database file.
+    # A passive checkpoint never waits for readers.  A truncate
+    # checkpoint waits for them, up to the busy timeout, and then
+    # empties the WAL file.  -> busy, WAL pages, pages checkpointed
+
+    def checkpoint(self, conn, mode="passive"):
+        cursor = conn.cursor()
+
+        try:
+            cursor.execute("pragma wal_checkpoint({})".format(mode))
+            return cursor.fetchone()
+        finally:
+            cursor.close()
+
+    # Merge the search index segments.  By default they are all merged
+    # into one, in a single transaction.  With pages set, the merge
+    # proceeds in steps of about that many pages, each committed on
+    # its own so a live database keeps taking writes between them.  It
+    # stops when there is nothing left to merge or after max_steps.
+    # -> number of steps taken
+
+    def optimize(self, pages=None, max_steps=None):
+        conn = self.connect()
+        cursor = conn.cursor()
+
+        try:
+            if pages is None:
+                cursor.execute("insert into messages_fts (messages_fts) values ('optimize')")
+                conn.commit()
+
+                # Frees one page per step; executescript runs it to the end
+                conn.executescript("pragma incremental_vacuum")
+
+                return 1
+
+            steps = 0
+
+            # A negative page count starts merging all the segments,
+            # however few there are; later steps continue that merge
+
+            while max_steps is None or steps < max_steps:
+                changes = conn.total_changes
+                rank = -pages if steps == 0 else pages
+
+                cursor.execute("insert into messages_fts (messages_fts, rank) "
+                               "values ('merge', ?)", [rank])
+                conn.commit()
+
+                steps += 1
+
+                # The merge writes nothing once the index is merged
+                if conn.total_changes - changes <= 1:
+                    break
+
+            return steps
+        finally:
+            conn.close()
+
+    # The importer stamps each new database with a fresh data version.
+    # Together with the generation of the request's connection, it
+    # identifies the data.  Cached objects from any other version are
+    # discarded.
+
+    def stamp_data_version(self):
+        conn = self.connect()
+        cursor = conn.cursor()
+
+        try:
+            cursor.execute("pragma user_version")
+            version = max(cursor.fetchone()[0] + 1, int(_time.time()))
+
+            cursor.execute("pragma user_version = {}".format(version))
+        finally:
+            conn.close()
+
+        return version
+
+    def get_data_version(self, request):
+        try:
+            return request.database_version
+        except AttributeError:
+            records = self.query(request, "pragma user_version")
+            generation = getattr(request.database_connection, "generation", 0)
+
+            request.database_version = generation, records[0][0]
+
+            return request.database_version
+
+    def cursor(self, request):
+        return request.database_connection.cursor()
+
+    def query(self, request, sql, *args):
+        cursor = self.cursor(request)
+        start = _time.perf_counter()
+
+        try:
+            cursor.execute(sql, args)
+            records = cursor.fetchall()
+        finally:
+            cursor.close()
+
+            elapsed = _time.perf_counter() - start
+            request.add_timing("sql", elapsed)
+
+        threshold = self.slow_query_threshold
+
+        if threshold is not None and elapsed >= threshold:
+            self._log_slow_query(request, sql, args, len(records), elapsed)
+
+        return records
+
+    def _log_slow_query(self, request, sql, args, count, elapsed):
+        try:
+            plan = self._explain(request, sql, args)
+        except _sqlite.Error as e:
+            plan = ["[Failed: {}]".format(str(e))]
+
+        lines = [
+            "Slow query ({:.3f}s, {} rows)".format(elapsed, count),
+            "  SQL: {}".format(sql),
+            "  Parameters: {}".format(list(args)),
+            "  Plan:",
+        ]
+
+        lines.extend(["    {}".format(x) for x in plan])
+
+        _slow_log.warning("\n".join(lines))
+
+    def _explain(self, request, sql, args):
+        cursor = self.cursor(request)
+
+        try:
+            cursor.execute("explain query plan {}".format(sql), args)
+            records = cursor.fetchall()
+        finally:
+            cursor.close()
+
+        depths = dict()
+        plan = list()
+
+        for id, parent, unused, detail in records:
+            depth = depths.get(parent, -1) + 1
+            depths[id] = depth
+
+            plan.append("{}{}".format("  " * depth, detail))
+
+        return plan
+
+    # Objects loaded during a request are kept in a per-request
+    # identity map, so each (class, ID) is queried at most once.  IDs
+    # known to be missing map to None.  Objects not yet in the map are
+    # looked for in the shared object cache before going to SQLite.
+
+    def get(self, request, cls, id):
+        _log.debug("Getting {} with ID {}".format(cls.__name__, id))
+
+        assert issubclass(cls, _DatabaseObject), cls
+        assert id is not None
+
+        objects = _get_identity_map(request)
+
+        if self._find_objects(request, cls, [id]):
+            sql = "select * from {} where id = ?".format(cls.table)
+            records = self.query(request, sql, id)
+
+            self._load_objects(request, cls, records)
+
+            objects.setdefault((cls, id), None)
+
+        obj = objects[(cls, id)]
+
+        if obj is None:
+            raise ObjectNotFound()
+
+        return obj
+
+    # -> dict of ID to object, for the IDs that exist
+
+    def get_many(self, request, cls, ids):
+        _log.debug("Getting {} {} objects".format(len(ids), cls.__name__))
+
+        assert issubclass(cls, _DatabaseObject), cls
+
+        objects = _get_identity_map(request)
+        missing = self._find_objects(request, cls, set(x for x in ids if x is not None))
+
+        if missing:
+            sql = "select * from {} where id in ({})"
+            sql = sql.format(cls.table, ", ".join(["?"] * len(missing)))
+            records = self.query(request, sql, *missing)
+
+            self._load_objects(request, cls, records)
+
+            for id in missing:
+                objects.setdefault((cls, id), None)
+
+        found = dict()
+
+        for id in ids:
+            obj = objects.get((cls, id))
+
+            if obj is not None:
+                found[id] = obj
+
+        return found
+
+    # Get an object along with the objects its reference fields point
+    # to, all in one query.  The referenced objects land in the
+    # identity map, so later calls to get() for them are free.
+
+    def get_with_references(self, request, cls, id, *fields):
+        _log.debug("Getting {} with ID {} and its references".format(cls.__name__, id))
+
+        assert issubclass(cls, _DatabaseObject), cls
+        assert id is not None
+
+        objects = _get_identity_map(request)
+
+        if not self._find_objects(request, cls, [id]):
+            obj = objects[(cls, id)]
+
+            if obj is None:
+                raise ObjectNotFound()
+
+            self.get_many(request, cls, [getattr(obj, x) for x in fields])
+
+            return obj
+
+        subqueries = ["(select {} from {} where id = ?)".format(x, cls.table) for x in fields]
+        sql = "select * from {} where id in (?, {})"
+        sql = sql.format(cls.table, ", ".join(subqueries))
+
+        records = self.query(request, sql, id, *([id] * len(fields)))
+
+        self._load_objects(request, cls, records)
+
+        obj = objects.setdefault((cls, id), None)
+
+        if obj is None:
+            raise ObjectNotFound()
+
+        for name in fields:
+            ref_id = getattr(obj, name)
+
+            if ref_id is not None:
+                objects.setdefault((cls, ref_id), None)
+
+        return obj
+
+    # Move what the shared cache has into the identity map.  -> the
+    # IDs still missing.
+
+    def _find_objects(self, request, cls, ids):
+        objects = _get_identity_map(request)
+        version = None
+        missing = list()
+
+        for id in ids:
+            key = (cls, id)
+
+            if key in objects:
+                continue
+
+            if version is None:
+                version = self.get_data_version(request)
+
+            obj = self.object_cache.get(version, key)
+
+            if obj is None:
+                missing.append(id)
+            else:
+                objects[key] = obj
+
+        return missing
+
+    def _load_objects(self, request, cls, records):
+        objects = _get_identity_map(request)
+        version = self.get_data_version(request)
+
+        for record in records:
+            obj = cls()
+            obj.load_from_record(record)
+
+            objects[(cls, obj.id)] = obj
+
+            self.object_cache.put(version, (cls, obj.id), obj, _record_size(record))
+
+    # -> SearchResults for the threads matching query.  Results are
+    # cached by a normalized form of the compiled
+    # query, so queries differing only in case, spacing, word endings
+    # or syntax share an entry.  Raises QueryError for queries that
+    # are malformed or too costly.
+
+    def search(self, request, query):
+        version = self.get_data_version(request)
+        cache = self.search_cache
+
+        query = " ".join(query.split())
+        entry = cache.get(version, ("query", query))
+
+        if entry is None:
+            compiled = compile_query(parse_query(query))
+            fts = self._normalize_query(request, compiled.fts)
+            key = fts, compiled.sql, tuple(compiled.args)
+            size = _sys.getsizeof(query) + _sys.getsizeof(fts) + _sys.getsizeof(compiled.sql)
+
+            entry = key, compiled
+            cache.put(version, ("query", query), entry, size)
+
+        key, compiled = entry
+        results = cache.get(version, ("threads", key))
+
+        if results is None:
+            # One row per matching message, with the rowid and date of
+            # its thread.  Only the newest matches are read, and one
+            # more, so that SearchResults can tell the set was cut.
+
+            predicates = ""
+
+            if compiled.predicates:
+                predicates = "and {}".format(compiled.sql)
+
+            sql = ("select t.rowid, t.date, m.list_id, m.from_address, m.date "
+                   "from (select m.thread_id, m.list_id, m.from_address, m.date "
+                   "      from messages_fts "
+                   "      join messages as m on m.rowid = messages_fts.rowid "
+                   "      where messages_fts match ? {} "
+                   "      order by m.date desc limit {}) as m "
+                   "join messages as t on t.id = m.thread_id")
+            sql = sql.format(predicates, SearchResults.max_matches + 1)
+
+            records = self.query(request, sql, compiled.fts, *compiled.args)
+            results = SearchResults(records)
+
+            cache.put(version, ("threads", key), results, results.size)
+
+        return results
+
+    # Run the query through the FTS tokenizer and put each term in the
+    # form the index stores it.  Prefix terms, which end in * or in "*
+    # for a phrase, and operators are left alone, as are the
+    # characters between terms.
+
+    def _normalize_query(self, request, query):
+        tokens = self._tokenize(request, query)
+        data = query.encode("utf-8")
+        parts = list()
+        prev = 0
+
+        for token, start, end in tokens:
+            term = data[start:end]
+
+            prefix = data[end:end + 1] == b"*" or data[end:end + 2] == b"\"*"
+
+            if not prefix and term not in _query_operators:
+                term = token.encode("utf-8")
+
+            parts.append(data[prev:start])
+            parts.append(term)
+
+            prev = end
+
+        parts.append(data[prev:])
+
+        return b"".join(parts).decode("utf-8")
+
+    def _tokenize(self, request, text):
+        cursor = self.cursor(request)
+
+        try:
+            return _tokenize(cursor, text)
+        finally:
+            cursor.close()
+
+    # -> list of suggested queries completing query.  Topics that
+    # start with the whole query come first, then the query with its
+    # last word completed.
+
+    def get_suggestions(self, request, query, limit=10):
+        query = " ".join(query.lower().split())
+
+        if not query:
+            return []
+
+        index = self._get_suggestion_index(request)
+        head, space, word = query.rpartition(" ")
+
+        suggestions = index.lookup(query, limit, topics=True)
+
+        for text in index.lookup(word, limit):
+            suggestion = head + space + text
+
+            if suggestion != query and suggestion not in suggestions:
+                suggestions.append(suggestion)
+
+        return suggestions[:limit]
+
+    # When the data version changes, the index is rebuilt in the
+    # background.  Until the new one is ready, requests keep using the
+    # previous one, or topics alone before the first build.
+
+    def _get_suggestion_index(self, request):
+        version = self.get_data_version(request)
+
+        with self._suggestion_lock:
+            index = self._suggestion_index
+
+            if index is not None and index.version == version:
+                return index
+
+            request.stale_suggestions = True
 
-        for topic in _topics:
-            href = self.app.search_page.get_href(request, query=topic)
-            text = xml_escape(topic)
+            if self._suggestion_builder is None:
+                self._suggestion_builder = _threading.Thread \
+                    (target=self._rebuild_suggestion_index, args=(version,), daemon=True)
+                self._suggestion_builder.start()
 
-            items.append(html_a(text, href))
+        if index is None:
+            index = SuggestionIndex(None, [], [x.lower() for x in _topics])
 
-        return html_ul(items, class_="four-column")
+        return index
 
-class _SearchPage(brbn.Page):
-    def __init__(self, app):
-        super().__init__(app, "/search", _strings["search_page_body"])
+    def _rebuild_suggestion_index(self, version):
+        index = None
 
-    def get_title(self, request):
-        query = request.get("query")
-        return "Search '{}'".format(query)
+        try:
+            conn = self.connect()
 
-    def render_query(self, request):
-        return request.get("query")
+            try:
+                index = self._build_suggestion_index(conn.cursor(), version)
+            finally:
+                conn.close()
+        except:
+            _log.exception("Failure building the suggestion index")
+        finally:
+            with self._suggestion_lock:
+                if index is not None:
+                    self._suggestion_index = index
 
-    @brbn.xml
-    def render_threads(self, request):
-        query = request.get("query")
+                self._suggestion_builder = None
 
-        sql = ("select * from messages where id in "
-               "(select distinct thread_id from messages_fts "
-               " where messages_fts match ? limit 1000) "
-               "order by date desc")
+    # Words used in at least two subjects, weighted by the number of
+    # messages their stem appears in, according to the FTS vocabulary.
+    # Words the index doesn't know are dropped; they would lead to
+    # empty results.
 
-        escaped_query = query.replace("\"", "\"\"")
+    def _build_suggestion_index(self, cursor, version):
+        _log.info("Building the suggestion index")
 
-        records = self.app.database.query(request, sql, escaped_query)
-        thread = Thread()
-        rows = list()
+        start = _time.perf_counter()
+        counts = _collections.Counter()
 
-        for record in records:
-            thread.load_from_record(record)
+        for subject, in cursor.execute("select subject from messages"):
+            words = set(_word_re.findall((subject or "").lower()))
+            counts.update(x for x in words if len(x) >= 3 and not x.isdigit())
 
-            thread_link = thread.get_link(request)
+        words = [x for x, n in counts.items() if n >= 2]
+        stems = dict()
 
-            row = [
-                thread_link,
-                xml_escape(thread.from_address),
-                thread.authored_words,
-                xml_escape(str(_email.formatdate(thread.date)[:-6])),
-            ]
+        # Tokenize all the words at once, and match each token to its
+        # word by byte offset
 
-            rows.append(row)
+        offsets = dict()
+        offset = 0
 
-        return html_table(rows, False, class_="messages four")
+        for word in words:
+            offsets[offset] = word
+            offset += len(word.encode("utf-8")) + 1
 
-class _ThreadPage(brbn.Page):
-    def __init__(self, app):
-        super().__init__(app, "/thread", _strings["thread_page_body"])
+        for token, offset, end in _tokenize(cursor, " ".join(words)):
+            word = offsets.get(offset)
 
-    def get_title(self, request):
-        return "Thread '{}'".format(request.thread.subject)
+            if word is not None:
+                stems[word] = token
 
-    def process(self, request):
-        id = request.get("id")
-        request.thread = self.app.database.get(request, Message, id)
+        cursor.execute("create virtual table if not exists temp.fts_terms "
+                       "using fts5vocab(main, messages_fts, row)")
+        cursor.execute("select term, doc from temp.fts_terms")
 
-        sql = ("select * from messages "
-               "where thread_id = ? "
-               "order by thread_position, date asc "
-               "limit 1000")
+        documents = dict(cursor.fetchall())
 
-        records = self.app.database.query(request, sql, request.thread.id)
+        entries = list()
 
-        request.messages = list()
-        request.messages_by_id = dict()
+        for word, stem in stems.items():
+            count = documents.get(stem)
 
-        for record in records:
-            message = Message()
-            message.load_from_record(record)
+            if count:
+                entries.append((word, count))
 
-            request.messages.append(message)
-            request.messages_by_id[message.id] = message
+        _log.info("Built the suggestion index in {:.3f}s".format(_time.perf_counter() - start))
 
-    def render_title(self, request):
-        return request.thread.subject
+        return SuggestionIndex(version, entries, [x.lower() for x in _topics])
 
-    @brbn.xml
-    def render_index(self, request):
-        rows = list()
+    # -> list of ListMonth objects, by list and month
 
-        for i, message in enumerate(request.messages):
-            date = _time.strftime("%d %b %Y", _time.gmtime(message.date))
-            number = i + 1
-            title = self.get_message_title(request, message, number)
+    def get_list_months(self, request):
+        sql = "select * from list_months order by list_id, month"
+        return [ListMonth(*x) for x in self.query(request, sql)]
 
-            row = [
-                html_a(xml_escape(title), "#{}".format(number)),
-                xml_escape(date),
-                message.authored_words,
-            ]
+    def get_list_month(self, request, list_id, month):
+        sql = "select * from list_months where list_id = ? and month = ?"
+        records = self.query(request, sql, list_id, month)
 
-            rows.append(row)
+        if not records:
+            raise ObjectNotFound()
 
-        return html_table(rows, False, class_="messages")
+        return ListMonth(*records[0])
 
-    @brbn.xml
-    def render_messages(self, request):
-        out = list()
+    # -> list of Thread objects started in list_month, newest first.
+    # Pages are found by key, not offset: before is the (date, ID) of
+    # the last thread on the previous page.
 
-        for i, message in enumerate(request.messages):
-            number = i + 1
-            title = self.get_message_title(request, message, number)
+    def get_list_threads(self, request, list_month, before=None, limit=100):
+        start, end = list_month.date_range
+        args = [list_month.list_id, start]
 
-            out.append(html_elem("h2", title, id=str(number)))
-            out.append(html_elem("pre", xml_escape(message.content)))
+        sql = ("select id, date, subject, from_name, message_count "
+               "from list_threads "
+               "where list_id = ? and date >= ? and {} "
+               "order by date desc, id desc limit ?")
 
-        return "\n".join(out)
+        # The key replaces the end of the month as the upper bound, so
+        # the index range starts right at the page
 
-    def get_message_title(self, request, message, number):
-        title = "{}. {}".format(number, message.from_name)
+        if before is None:
+            sql = sql.format("date < ?")
+            args.append(end)
+        else:
+            sql = sql.format("(date, id) < (?, ?)")
+            args.extend(min(tuple(before), (end, "")))
 
-        if message.in_reply_to_id is not None:
-            rmessage = request.messages_by_id.get(message.in_reply_to_id)
+        records = self.query(request, sql, *args, limit)
+        threads = list()
 
-            if rmessage is not None:
-                rperson = rmessage.from_name
-                title = "{} replying to {}".format(title, rperson)
+        for id, date, subject, from_name, message_count in records:
+            thread = Thread()
+            thread.id = id
+            thread.date = int(date)
+            thread.subject = subject
+            thread.from_name = from_name
+            thread.message_count = message_count
 
-        return title
+            threads.append(thread)
 
-class _MessagePage(brbn.Page):
-    def __init__(self, app):
-        super().__init__(app, "/message", _strings["message_page_body"])
+        return threads
 
-    def get_title(self, request):
-        return "Message '{}'".format(request.message.subject)
+    # -> list of the senders with the most messages
 
-    def process(self, request):
-        id = request.get("id")
-        request.message = self.app.database.get(request, Message, id)
-    
-    def render_title(self, request):
-        return request.message.subject
+    def get_top_senders(self, request, limit=40):
+        sql = "select * from senders order by message_count desc limit ?"
+        records = self.query(request, sql, limit)
+        senders = list()
 
-    @brbn.xml
-    def render_thread_link(self, request):
-        thread = None
-        thread_id = request.message.thread_id
-        thread_link = xml_escape(thread_id)
+        for record in records:
+            sender = Sender()
+            sender.load_from_record(record)
 
-        if thread_id is not None:
-            try:
-                thread = self.app.database.get(request, Message, thread_id)
-            except ObjectNotFound:
-                pass
+            senders.append(sender)
 
-            if thread is not None:
-                thread_link = thread.get_link(request)
+        return senders
 
-        return thread_link
+    # -> list of Message objects from sender, newest first.  This is a
+    # range scan of the (from_address, date) index.
 
-    @brbn.xml
-    def render_in_reply_to_link(self, request):
-        rmessage = None
-        rmessage_id = request.message.in_reply_to_id
-        rmessage_link = nvl(xml_escape(rmessage_id), "[None]")
+    def get_sender_messages(self, request, sender, offset=0, limit=100):
+        sql = ("select id, subject, authored_words, date from messages "
+               "where from_address = ? order by date desc limit ? offset ?")
 
-        if rmessage_id is not None:
-            try:
-                rmessage = self.database.get(request, Message, rmessage_id)
-            except ObjectNotFound:
-                pass
+        records = self.query(request, sql, sender.id, limit, offset)
+        messages = list()
 
-            if rmessage is not None:
-                rmessage_link = rmessage.get_link(request)
+        for id, subject, authored_words, date in records:
+            message = Message()
+            message.id = id
+            message.subject = subject
+            message.authored_words = authored_words
+            message.date = int(date)
 
-        return rmessage_link
+            messages.append(message)
 
-    @brbn.xml
-    def render_headers(self, request):
-        message = request.message
-        from_field = "{} <{}>".format(message.from_name, message.from_address)
+        return messages
 
-        items = (
-            ("ID", xml_escape(message.id)),
-            ("List", xml_escape(message.list_id)),
-            ("From", xml_escape(from_field)),
-            ("Date", xml_escape(_email.formatdate(message.date))),
-            ("Subject", xml_escape(message.subject)),
-        )
+    # -> list of Thread objects, in rowids order.  Only the fields
+    # shown in thread listings are loaded.
 
-        return html_table(items, False, True, class_="headers")
+    def get_threads(self, request, rowids):
+        if not rowids:
+            return []
 
-    @brbn.xml
-    def render_content(self, request):
-        message = request.message
-        content = ""
+        sql = ("select rowid, id, from_address, authored_words, date, subject "
+               "from messages where rowid in ({})")
+        sql = sql.format(", ".join(["?"] * len(rowids)))
 
-        if message.content is not None:
-            lines = list()
+        records = self.query(request, sql, *rowids)
+        threads = dict()
 
-            for line in message.content.splitlines():
-                line = line.strip()
+        for rowid, id, from_address, authored_words, date, subject in records:
+            thread = Thread()
+            thread.id = id
+            thread.from_address = from_address
+            thread.authored_words = authored_words
+            thread.date = int(date)
+            thread.subject = subject
 
-                if line.startswith(">"):
-                    m = _re.match("^[> ]+", line)
-                    prefix = "\n{}".format(m.group(0))
+            threads[rowid] = thread
 
-                    line = prefix.join(_textwrap.wrap(line, 80))
-                    line = html_span(xml_escape(line), class_="quoted")
-                else:
-                    line = "\n".join(_textwrap.wrap(line, 80))
-                    line = xml_escape(line)
+        return [threads[x] for x in rowids if x in threads]
 
-                lines.append(line)
+    # Load the whole reply tree of a thread in one indexed query.
+    # Content is fetched only for the messages in the requested page.
 
-            content = "\n".join(lines)
+    def get_thread(self, request, id, offset=0, limit=1000):
+        _log.debug("Getting thread with ID {}".format(id))
 
-        return content
+        assert id is not None
 
-class Database:
-    def __init__(self, path):
-        self.path = path
+        sql = ("select id, in_reply_to_id, from_name, date, authored_words, "
+               "subject, thread_position, number, "
+               "case when number > ? and number <= ? "
+               "then rendered_content end, "
+               "case when number > ? and number <= ? "
+               "and rendered_content is null then content end "
+               "from (select *, row_number() over "
+               "(order by thread_position, date) as number "
+               "from messages where thread_id = ?) "
+               "order by number")
 
-        _log.info("Using database at {}".format(self.path))
+        key = (ThreadTree, id, offset, limit)
+        version = self.get_data_version(request)
+        thread = self.object_cache.get(version, key)
 
-    def connect(self):
-        # XXX thread local connections
-        return _sqlite.connect(self.path)
+        if thread is not None:
+            return thread
 
-    def create_schema(self):
-        columns = list()
+        end = offset + limit
+        records = self.query(request, sql, offset, end, offset, end, id)
 
-        for name in Message.fields:
-            field_type = Message.field_types.get(name, str)
-            column_type = "text"
+        thread = ThreadTree(id)
 
-            if field_type == int:
-                column_type = "integer"
+        for record in records:
+            thread._add_entry(_ThreadEntry(record, offset, end))
 
-            column = "{} {}".format(name, column_type)
+        if thread.root is None:
+            raise ObjectNotFound()
 
-            columns.append(column)
+        size = sum(_record_size(x) for x in records)
+        self.object_cache.put(version, key, thread, size)
 
-        statements = list()
+        return thread
 
-        columns = ", ".join(columns)
-        ddl = "create table messages ({});".format(columns)
-        statements.append(ddl)
+def _column_definition(name):
+    field_type = Message.field_types.get(name, str)
+    column_type = "text"
 
-        ddl = "create index messages_id_idx on messages (id);"
-        statements.append(ddl)
+    if field_type == int:
+        column_type = "integer"
 
-        columns = ", ".join(Message.fts_fields)
-        ddl = ("create virtual table messages_fts using fts4 "
-               "({}, notindexed=id, notindexed=thread_id, tokenize=porter)"
-               "".format(columns))
+    return "{} {}".format(name, column_type)
 
-        statements.append(ddl)
+# The search index is an FTS5 table with external content: it stores
+# only the index and reads the text from messages by rowid.  Triggers
+# keep it in step with messages.  The prefix index matches
+# searching.min_prefix_length.  Without column sizes there is no bm25
+# ranking, which search doesn't use.
+#
+# messages has no integer primary key, so VACUUM may renumber its
+# rows.  Run "insert into messages_fts (messages_fts) values
+# ('rebuild')" after any VACUUM.
+
+def _fts_schema():
+    fields = Message.fts_fields
+    columns = ", ".join(fields)
+    new = ", ".join("new.{}".format(x) for x in fields)
+    old = ", ".join("old.{}".format(x) for x in fields)
+
+    insert = ("insert into messages_fts (rowid, {}) values (new.rowid, {});"
+              "".format(columns, new))
+    delete = ("insert into messages_fts (messages_fts, rowid, {}) "
+              "values ('delete', old.rowid, {});".format(columns, old))
+
+    return (
+        ("create virtual table if not exists messages_fts using fts5 "
+         "({}, content=messages, tokenize='porter unicode61', prefix=3, "
+         "columnsize=0)".format(columns)),
+        ("create trigger if not exists messages_fts_insert after insert on messages "
+         "begin {} end".format(insert)),
+        ("create trigger if not exists messages_fts_delete after delete on messages "
+         "begin {} end".format(delete)),
+        ("create trigger if not exists messages_fts_update after update of {} on messages "
+         "begin {} {} end".format(columns, delete, insert)),
+    )
+
+# -> list of (token, start byte, end byte), as the FTS index
+# tokenizes text.  FTS5 has no tokenizer table, so this uses the FTS3
+# porter tokenizer.  It stems the same way but doesn't fold non-ASCII
+# case or diacritics as unicode61 does; the index folds those again
+# when it runs the query.
+
+def _tokenize(cursor, text):
+    cursor.execute("create virtual table if not exists temp.query_tokens "
+                   "using fts3tokenize(porter)")
+    cursor.execute("select token, start, end from temp.query_tokens "
+                   "where input = ?", [text])
+
+    return cursor.fetchall()
+
+# A rough measure of the memory an object built from record holds
+
+def _record_size(record):
+    return _sys.getsizeof(record) + sum(_sys.getsizeof(x) for x in record)
+
+# A thread-safe LRU cache of database objects, bounded by the
+# estimated size of its entries in bytes.  Cached objects are shared
+# between requests and must not be modified.
+
+class ObjectCache:
+    def __init__(self, name, budget=64 * 1024 * 1024):
+        self.name = name
+        self.budget = budget
+        self.size = 0
+        self.version = None
+        self.hits = 0
+        self.misses = 0
+
+        self._entries = _collections.OrderedDict()
+        self._lock = _threading.Lock()
 
-        conn = self.connect()
-        cursor = conn.cursor()
+    def __repr__(self):
+        return format_repr(self, self.name, len(self._entries), self.size)
 
-        try:
-            for statement in statements:
-                cursor.execute(statement)
-        finally:
-            conn.close()
+    def get(self, version, key):
+        with self._lock:
+            self._check_version(version)
 
-    def optimize(self):
-        conn = self.connect()
-        cursor = conn.cursor()
+            try:
+                obj, size = self._entries[key]
+            except KeyError:
+                self.misses += 1
+                return
 
-        ddl = "insert into messages_fts (messages_fts) values ('optimize')"
+            self._entries.move_to_end(key)
+            self.hits += 1
 
-        try:
-            cursor.execute(ddl)
-        finally:
-            conn.close()
+            return obj
 
-    def cursor(self, request):
-        return request.database_connection.cursor()
+    def put(self, version, key, obj, size):
+        if size > self.budget:
+            return
 
-    def query(self, request, sql, *args):
-        cursor = self.cursor(request)
+        with self._lock:
+            self._check_version(version)
 
-        try:
-            cursor.execute(sql, args)
-            return cursor.fetchall()
-        finally:
-            cursor.close()
+            old = self._entries.pop(key, None)
 
-    def get(self, request, cls, id):
-        _log.debug("Getting {} with ID {}".format(cls.__name__, id))
+            if old is not None:
+                self.size -= old[1]
 
-        assert issubclass(cls, _DatabaseObject), cls
-        assert id is not None
+            self._entries[key] = obj, size
+            self.size += size
 
-        sql = "select * from {} where id = ?".format(cls.table)
-        cursor = self.cursor(request)
+            while self.size > self.budget:
+                key, (obj, size) = self._entries.popitem(last=False)
+                self.size -= size
 
-        try:
-            cursor.execute(sql, [id])
-            record = cursor.fetchone()
-        finally:
-            cursor.close()
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
 
-        if record is None:
-            raise ObjectNotFound()
+    def _check_version(self, version):
+        if version != self.version:
+            if self.version is not None:
+                _log.info("Data version changed; clearing the {} cache".format(self.name))
 
-        obj = cls()
-        obj.load_from_record(record)
+            self._entries.clear()
+            self.size = 0
+            self.version = version
 
-        return obj
+def _get_identity_map(request):
+    try:
+        return request.database_objects
+    except AttributeError:
+        request.database_objects = dict()
+        return request.database_objects
 
-class ObjectNotFound(Exception):
+class ObjectNotFound(brbn.ObjectNotFound):
     pass
 
 class _DatabaseObject:
     table = None
+    fields = []
+    field_types = {}
 
     def __init__(self, id, name, parent=None):
         self.id = id
@@ -394,6 +1894,20 @@ class _DatabaseObject:
     def name(self):
         return self._name
 
+    def load_from_record(self, record):
+        # Records from older databases may lack the newer fields
+        if len(record) < len(self.fields):
+            record = tuple(record) + (None,) * (len(self.fields) - len(record))
+
+        for i, name in enumerate(self.fields):
+            value = record[i]
+            field_type = self.field_types.get(name, str)
+
+            if value is not None:
+                value = field_type(value)
+
+            setattr(self, name, value)
+
     def get_link_href(self, request):
         raise NotImplementedError()
 
@@ -425,6 +1939,7 @@ class Message(_DatabaseObject):
         "authored_words",
         "thread_id",
         "thread_position",
+        "rendered_content",
     ]
 
     field_types = {
@@ -441,9 +1956,10 @@ class Message(_DatabaseObject):
         "content_type": "Content-Type",
     }
 
+    # Indexed for search.  The index reads them from the messages
+    # table and is kept in sync by triggers.
+
     fts_fields = [
-        "id",
-        "thread_id",
         "subject",
         "authored_content",
     ]
@@ -484,16 +2000,7 @@ class Message(_DatabaseObject):
         self.content = content
         self.authored_content = _get_authored_content(self.content)
         self.authored_words = len(self.authored_content.split())
-
-    def load_from_record(self, record):
-        for i, name in enumerate(self.fields):
-            value = record[i]
-            field_type = self.field_types.get(name, str)
-
-            if value is not None:
-                value = field_type(value)
-
-            setattr(self, name, value)
+        self.rendered_content = render_message_content(self.content)
 
     def save(self, cursor):
         columns = ", ".join(self.fields)
@@ -504,13 +2011,8 @@ class Message(_DatabaseObject):
 
         cursor.execute(dml, args)
 
-        columns = ", ".join(self.fts_fields)
-        values = ", ".join("?" * len(self.fts_fields))
-        args = [getattr(self, x) for x in self.fts_fields]
-
-        dml = "insert into messages_fts ({}) values ({})".format(columns, values)
-
-        cursor.execute(dml, args)
+        if self.from_address is not None:
+            Sender.record_message(cursor, self)
 
     def get_link_href(self, request):
         return request.app.message_page.get_href(request, id=self.id)
@@ -518,10 +2020,236 @@ class Message(_DatabaseObject):
     def get_link_title(self, request):
         return self.subject
 
+class Sender(_DatabaseObject):
+    table = "senders"
+
+    fields = [
+        "id",
+        "from_name",
+        "message_count",
+        "first_date",
+        "last_date",
+    ]
+
+    field_types = {
+        "message_count": int,
+        "first_date": int,
+        "last_date": int,
+    }
+
+    def __init__(self):
+        super().__init__(None, None)
+
+        for name in self.fields:
+            setattr(self, name, None)
+
+    @property
+    def address(self):
+        return self.id
+
+    @property
+    def name(self):
+        if self.from_name:
+            return "{} <{}>".format(self.from_name, self.id)
+
+        return self.id
+
+    @staticmethod
+    def record_message(cursor, message):
+        dml = ("insert into senders values (?, ?, 1, ?, ?) "
+               "on conflict (id) do update set "
+               "from_name = coalesce(nullif(excluded.from_name, ''), from_name), "
+               "message_count = message_count + 1, "
+               "first_date = min(first_date, excluded.first_date), "
+               "last_date = max(last_date, excluded.last_date)")
+
+        cursor.execute(dml, [message.from_address, message.from_name,
+                             message.date, message.date])
+
+    def get_link_href(self, request):
+        return request.app.sender_page.get_href(request, id=self.id)
+
+class ListMonth:
+    def __init__(self, list_id, month, thread_count, message_count):
+        self.list_id = list_id
+        self.month = month
+        self.thread_count = thread_count
+        self.message_count = message_count
+
+    def __repr__(self):
+        return format_repr(self, self.list_id, self.month)
+
+    @property
+    def list_name(self):
+        return self.list_id.strip("<>")
+
+    @property
+    def name(self):
+        year, month = self.month.split("-")
+        return "{} {} {}".format(self.list_name, _calendar.month_name[int(month)], year)
+
+    # -> start, end in UTC seconds
+    @property
+    def date_range(self):
+        year, month = [int(x) for x in self.month.split("-")]
+        start = _calendar.timegm((year, month, 1, 0, 0, 0))
+
+        if month == 12:
+            year, month = year + 1, 1
+        else:
+            month += 1
+
+        return start, _calendar.timegm((year, month, 1, 0, 0, 0))
+
 class Thread(Message):
     def get_link_href(self, request):
         return request.app.thread_page.get_href(request, id=self.id)
 
+# The threads matching a search, newest first, with counts of matching
+# threads by list, sender, and year.  The counts are made in the same
+# pass over the matching messages that collects the threads.  Only the
+# newest max_matches messages are counted; truncated is set when there
+# were more, and the counts are then lower bounds.  The rowids are
+# held in an array to keep cached results small.
+
+class SearchResults:
+    max_matches = 5000
+    max_threads = 1000
+    sender_count = 10
+
+    def __init__(self, records):
+        self.truncated = len(records) > self.max_matches
+
+        records = records[:self.max_matches]
+        threads = dict()
+        lists = set()
+        senders = set()
+        years = set()
+
+        for rowid, thread_date, list_id, from_address, date in records:
+            threads[rowid] = thread_date or 0
+
+            lists.add((list_id, rowid))
+            senders.add((from_address, rowid))
+
+            if date is not None:
+                years.add((_time.gmtime(date).tm_year, rowid))
+
+        rowids = sorted(threads, key=threads.__getitem__, reverse=True)
+
+        self.rowids = _array.array("q", rowids[:self.max_threads])
+        self.lists = _collections.Counter(x[0] for x in lists).most_common()
+        self.senders = _collections.Counter(x[0] for x in senders) \
+                                   .most_common(self.sender_count)
+        self.years = sorted(_collections.Counter(x[0] for x in years).items(),
+                            reverse=True)
+
+    def __repr__(self):
+        return format_repr(self, len(self.rowids))
+
+    @property
+    def size(self):
+        facets = self.lists + self.senders + self.years
+        return _sys.getsizeof(self.rowids) + sum(_record_size(x) for x in facets)
+
+# Completions for a prefix, by bisecting a sorted array of entries.
+# The best completions for prefixes of up to indexed_prefix_length
+# characters are computed up front, since those prefixes match the
+# most entries.  Longer prefixes match few enough to rank on lookup.
+
+class SuggestionIndex:
+    indexed_prefix_length = 3
+    max_results = 10
+
+    def __init__(self, version, entries, topics=()):
+        self.version = version
+
+        entries = sorted(entries)
+
+        self._keys = [x[0] for x in entries]
+        self._weights = [x[1] for x in entries]
+        self._topics = sorted(topics)
+        self._top = dict()
+
+        by_prefix = _collections.defaultdict(list)
+
+        for i, key in enumerate(self._keys):
+            for length in range(1, min(len(key), self.indexed_prefix_length) + 1):
+                by_prefix[key[:length]].append(i)
+
+        for prefix, indexes in by_prefix.items():
+            best = _heapq.nlargest(self.max_results, indexes, key=self._weights.__getitem__)
+            self._top[prefix] = [self._keys[x] for x in best]
+
+    def __repr__(self):
+        return format_repr(self, self.version, len(self._keys))
+
+    # -> list of entries, or with topics of topics, starting with
+    # prefix
+
+    def lookup(self, prefix, limit=max_results, topics=False):
+        if topics:
+            keys = self._topics
+            lo = _bisect.bisect_left(keys, prefix)
+            hi = _bisect.bisect_left(keys, prefix + "\uffff")
+
+            return keys[lo:min(hi, lo + limit)]
+
+        if len(prefix) <= self.indexed_prefix_length:
+            return self._top.get(prefix, [])[:limit]
+
+        lo = _bisect.bisect_left(self._keys, prefix)
+        hi = _bisect.bisect_left(self._keys, prefix + "\uffff")
+
+        best = _heapq.nlargest(limit, range(lo, hi), key=self._weights.__getitem__)
+
+        return [self._keys[x] for x in best]
+
+class ThreadTree:
+    def __init__(self, id):
+        self.id = id
+        self.root = None
+        self.entries = list()
+        self.entries_by_id = dict()
+
+    def __repr__(self):
+        return format_repr(self, self.id)
+
+    @property
+    def subject(self):
+        return self.root.subject
+
+    @property
+    def name(self):
+        return self.subject
+
+    def _add_entry(self, entry):
+        parent = self.entries_by_id.get(entry.in_reply_to_id)
+
+        if parent is not None:
+            entry.parent_name = parent.from_name
+            entry.title = "{} replying to {}".format(entry.title, parent.from_name)
+
+        if entry.id == self.id:
+            self.root = entry
+
+        self.entries.append(entry)
+        self.entries_by_id[entry.id] = entry
+
+class _ThreadEntry:
+    __slots__ = ("id", "in_reply_to_id", "from_name", "date", "authored_words",
+                 "subject", "depth", "number", "rendered_content", "content",
+                 "on_page", "parent_name", "title")
+
+    def __init__(self, record, offset, end):
+        (self.id, self.in_reply_to_id, self.from_name, self.date,
+         self.authored_words, self.subject, self.depth, self.number,
+         self.rendered_content, self.content) = record
+
+        self.on_page = offset < self.number <= end
+        self.parent_name = None
+        self.title = "{}. {}".format(self.number, self.from_name)
+
 def _get_mbox_content(mbox_message):
     content_type = None
     content_encoding = None
@@ -551,6 +2279,34 @@ def _get_mbox_content(mbox_message):
 
     return content
 
+_quote_prefix_regex = _re.compile("^[> ]+")
+
+# Archived messages never change, so the importer renders the content
+# once and stores it with the message
+
+def render_message_content(content):
+    if content is None:
+        return ""
+
+    lines = list()
+
+    for line in content.splitlines():
+        line = line.strip()
+
+        if line.startswith(">"):
+            m = _quote_prefix_regex.match(line)
+            prefix = "\n{}".format(m.group(0))
+
+            line = prefix.join(_textwrap.wrap(line, 80))
+            line = html_span(xml_escape(line), class_="quoted")
+        else:
+            line = "\n".join(_textwrap.wrap(line, 80))
+            line = xml_escape(line)
+
+        lines.append(line)
+
+    return "\n".join(lines)
+
 def _get_authored_content(content):
     lines = list()
 
@@ -21,6 +21,8 @@ import os as _os
 import re as _re
 import time as _time
 
+from escaping import xml_escape
+from escaping import xml_unescape
 from pprint import pformat as _pformat
 
 try:
@@ -33,9 +35,6 @@ try:
 except ImportError:
     from urllib import unquote_plus as _url_unescape
 
-from xml.sax.saxutils import escape as _xml_escape
-from xml.sax.saxutils import unescape as _xml_unescape
-
 # String formatting functions
 
 def nvl(value, substitution, template=None):
@@ -240,24 +239,6 @@ def url_unescape(string):
 
     return _url_unescape(string)
 
-_extra_entities = {
-    '"': "&quot;",
-    "'": "&#x27;",
-    "/": "&#x2F;",
-}
-
-def xml_escape(string):
-    if string is None:
-        return
-
-    return _xml_escape(string, _extra_entities)
-
-def xml_unescape(string):
-    if string is None:
-        return
-
-    return _xml_unescape(string)
-
 _strip_tags_regex = _re.compile(r"<[^<]+?>")
 
 def strip_tags(string):
@@ -344,34 +325,95 @@ def html_section(content, **attrs):
 
 def html_table(items, first_row_headings=True, first_col_headings=False,
                escape_cell_data=False, **attrs):
-    row_headings = list()
-    rows = list()
+    rows = _iter_html_table_rows(items, first_row_headings, first_col_headings,
+                                 escape_cell_data)
+
+    return "<table{}><tbody>\n{}\n</tbody></table>".format \
+        (_html_attrs(attrs), "\n".join(rows))
+
+def html_table_append(out, items, first_row_headings=True,
+                      first_col_headings=False, escape_cell_data=False,
+                      **attrs):
+    """Append the pieces of the table to list out"""
+    out.extend(iter_html_table(items, first_row_headings, first_col_headings,
+                               escape_cell_data, **attrs))
+
+def iter_html_table(items, first_row_headings=True, first_col_headings=False,
+                    escape_cell_data=False, **attrs):
+    """Generate the table in pieces, one per row"""
+    rows = _iter_html_table_rows(items, first_row_headings, first_col_headings,
+                                 escape_cell_data)
+
+    yield "<table{}><tbody>\n".format(_html_attrs(attrs))
+
+    for row in rows:
+        yield row
+        break
+
+    for row in rows:
+        yield "\n"
+        yield row
+
+    yield "\n</tbody></table>"
+
+# Rows are rendered with a format string per row length, built once,
+# instead of with a function call and attribute walk per cell
+
+_html_row_formats = dict()
+
+def _html_row_format(length, first_col_headings, headings=False):
+    key = length, first_col_headings, headings
+
+    try:
+        return _html_row_formats[key]
+    except KeyError:
+        pass
+
+    cells = list()
+
+    for i in range(length):
+        if headings or (i == 0 and first_col_headings):
+            cells.append("<th>{}</th>")
+        else:
+            cells.append("<td>{}</td>")
+
+    format = "<tr>{}</tr>".format("".join(cells)).format
+
+    _html_row_formats[key] = format
+
+    return format
+
+def _iter_html_table_rows(items, first_row_headings, first_col_headings,
+                          escape_cell_data):
+    items = iter(items)
 
     if first_row_headings:
-        for cell in items[0]:
-            row_headings.append(html_th(cell))
+        for item in items:
+            if None in item:
+                item = ["" if x is None else x for x in item]
 
-        rows.append(html_tr("".join(row_headings)))
+            yield _html_row_format(len(item), False, True)(*item)
+
+            break
+
+    formats = dict()
 
-        items = items[1:]
-        
     for item in items:
-        cols = list()
+        length = len(item)
 
-        for i, cell in enumerate(item):
-            if escape_cell_data:
-                cell = xml_escape(cell)
-            
-            if i == 0 and first_col_headings:
-                cols.append(html_th(cell))
-            else:
-                cols.append(html_td(cell))
+        try:
+            format = formats[length]
+        except KeyError:
+            format = _html_row_format(length, first_col_headings)
+            formats[length] = format
 
-        rows.append(html_tr("".join(cols)))
+        if escape_cell_data:
+            item = [xml_escape(x) for x in item]
 
-    tbody = html_elem("tbody", "\n{}\n".format("\n".join(rows)))
-        
-    return _html_elem("table", tbody, attrs)
+        if None in item:
+            item = ["" if x is None else x for x in item]
+
+        yield format(*item)
 
 def html_ul(items, **attrs):
     out = list()
@@ -0,0 +1,505 @@
+#
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+#
+
+import calendar as _calendar
+import re as _re
+
+# The search query language
+#
+#   broker queue          Both words (AND is implied)
+#   broker OR queue       Either word
+#   broker -queue         broker but not queue (also NOT queue)
+#   broker -(a OR b)      broker but neither a nor b
+#   "message broker"      The phrase
+#   brok*                 Words starting with brok
+#   (a OR b) c            Grouping
+#   subject:broker        In the subject
+#   from:alice            Sender name or address contains alice
+#   list:dev              On the dev list
+#   date:2015             During 2015; also 2015-03 and 2015-03-01
+#   date:2014..2015-06    From the start of 2014 to the end of June 2015
+#
+# Queries are parsed into a tree of nodes and compiled to an FTS
+# match expression plus SQL predicates on the messages table.  User
+# text reaches the match expression only as runs of word characters,
+# so no input can change its structure.  Queries that would scan the
+# whole index are rejected with QueryError.
+
+max_query_length = 500
+max_terms = 16
+max_depth = 8
+min_prefix_length = 3
+
+_filter_fields = ("from", "list", "date")
+_fields = ("subject",) + _filter_fields
+
+_token_re = _re.compile(r'\s+|[()]|-?"[^"]*"?|[^\s()"]+:"[^"]*"?|[^\s()"]+')
+_field_re = _re.compile(r"([a-z]+):(.+)$", _re.IGNORECASE)
+_word_re = _re.compile(r"[^\W_]+")
+_date_re = _re.compile(r"(\d{4})(?:-(\d{1,2}))?(?:-(\d{1,2}))?$")
+
+class QueryError(Exception):
+    pass
+
+class Term:
+    def __init__(self, words, prefix=False, field=None):
+        self.words = words
+        self.prefix = prefix
+        self.field = field
+
+    def __repr__(self):
+        return "Term({!r}, prefix={}, field={})".format(self.words, self.prefix, self.field)
+
+class Phrase:
+    def __init__(self, words, field=None):
+        self.words = words
+        self.field = field
+
+    def __repr__(self):
+        return "Phrase({!r}, field={})".format(self.words, self.field)
+
+class Filter:
+    def __init__(self, field, value):
+        self.field = field
+        self.value = value
+
+    def __repr__(self):
+        return "Filter({}, {!r})".format(self.field, self.value)
+
+class And:
+    def __init__(self, children):
+        self.children = children
+
+    def __repr__(self):
+        return "And({!r})".format(self.children)
+
+class Or:
+    def __init__(self, children):
+        self.children = children
+
+    def __repr__(self):
+        return "Or({!r})".format(self.children)
+
+class Not:
+    def __init__(self, child):
+        self.child = child
+
+    def __repr__(self):
+        return "Not({!r})".format(self.child)
+
+class CompiledQuery:
+    def __init__(self, fts, predicates, args):
+        self.fts = fts
+        self.predicates = predicates
+        self.args = args
+
+    def __repr__(self):
+        return "CompiledQuery({!r}, {!r}, {!r})".format(self.fts, self.predicates, self.args)
+
+    @property
+    def sql(self):
+        return " and ".join(self.predicates)
+
+def parse_query(text):
+    if len(text) > max_query_length:
+        raise QueryError("The query is longer than {} characters".format(max_query_length))
+
+    parser = _Parser(text)
+    node = parser.parse()
+
+    if parser.term_count > max_terms:
+        raise QueryError("The query has more than {} terms".format(max_terms))
+
+    return node
+
+def compile_query(node):
+    return _Compiler().compile(node)
+
+class _Parser:
+    def __init__(self, text):
+        self.tokens = [x for x in _token_re.findall(text) if not x.isspace()]
+        self.pos = 0
+        self.depth = 0
+        self.term_count = 0
+
+    def parse(self):
+        node = self.parse_or()
+
+        if self.peek() is not None:
+            raise QueryError("Unexpected '{}'".format(self.peek()))
+
+        if node is None:
+            raise QueryError("The query has no search terms")
+
+        return node
+
+    def peek(self):
+        if self.pos < len(self.tokens):
+            return self.tokens[self.pos]
+
+    def next(self):
+        token = self.peek()
+        self.pos += 1
+        return token
+
+    def parse_or(self):
+        children = [self.parse_and()]
+
+        while self.peek() == "OR":
+            self.next()
+            children.append(self.parse_and())
+
+        children = [x for x in children if x is not None]
+
+        if len(children) == 1:
+            return children[0]
+
+        if children:
+            return Or(children)
+
+    def parse_and(self):
+        children = list()
+
+        while self.peek() not in (None, ")", "OR"):
+            if self.peek() == "AND":
+                self.next()
+                continue
+
+            node = self.parse_unary()
+
+            if node is not None:
+                children.append(node)
+
+        if len(children) == 1:
+            return children[0]
+
+        if children:
+            return And(children)
+
+    def parse_unary(self):
+        token = self.peek()
+
+        if token in (None, ")", "OR"):
+            return
+
+        if token == "NOT":
+            self.next()
+            return self.negate(self.parse_unary())
+
+        # A lone - negates what follows it, such as a group in -(a b)
+
+        if token == "-":
+            self.next()
+
+            if self.peek() in (None, ")", "OR"):
+                raise QueryError("Nothing follows '-'")
+
+            node = self.parse_primary()
+
+            if node is None:
+                raise QueryError("Nothing follows '-'")
+
+            return Not(node)
+
+        if token.startswith("-"):
+            self.tokens[self.pos] = token[1:]
+            return self.negate(self.parse_unary())
+
+        return self.parse_primary()
+
+    def negate(self, node):
+        if node is not None:
+            return Not(node)
+
+    def parse_primary(self):
+        token = self.next()
+
+        if token == "(":
+            self.depth += 1
+
+            if self.depth > max_depth:
+                raise QueryError("The query is nested too deeply")
+
+            node = self.parse_or()
+
+            if self.next() != ")":
+                raise QueryError("Missing ')'")
+
+            self.depth -= 1
+
+            return node
+
+        if token == ")":
+            raise QueryError("Unexpected ')'")
+
+        match = _field_re.match(token)
+
+        if match is not None and match.group(1).lower() in _fields:
+            field = match.group(1).lower()
+            value = match.group(2)
+
+            if field in _filter_fields:
+                return Filter(field, value.strip("\""))
+
+            return self.parse_text(value, field)
+
+        return self.parse_text(token)
+
+    def parse_text(self, token, field=None):
+        if token.startswith("\""):
+            words = _word_re.findall(token)
+
+            if not words:
+                return
+
+            self.term_count += len(words)
+
+            if len(words) == 1:
+                return Term(words, field=field)
+
+            return Phrase(words, field)
+
+        prefix = token.endswith("*")
+        words = _word_re.findall(token)
+
+        if not words:
+            return
+
+        if prefix and len(words[-1]) < min_prefix_length:
+            raise QueryError("Prefix searches need at least {} characters before '*'"
+                             .format(min_prefix_length))
+
+        self.term_count += len(words)
+
+        return Term(words, prefix, field)
+
+class _Compiler:
+    def __init__(self):
+        self.predicates = list()
+        self.args = list()
+
+    def compile(self, node):
+        clauses = list(_flatten(node))
+        positive = list()
+        negative = list()
+
+        # Filters are predicates on the matched messages, so they can
+        # appear only at the top level, possibly negated
+
+        for clause in clauses:
+            if isinstance(clause, Filter):
+                self.add_filter(clause, False)
+            elif isinstance(clause, Not) and isinstance(clause.child, Filter):
+                self.add_filter(clause.child, True)
+            elif isinstance(clause, Not):
+                negative.append(self.compile_fts(clause.child))
+            else:
+                positive.append(self.compile_fts(clause))
+
+        if not positive:
+            raise QueryError("The query needs at least one word to search for")
+
+        fts = " AND ".join(positive)
+
+        for expr in negative:
+            fts = "{} NOT {}".format(fts, expr)
+
+        return CompiledQuery(fts, self.predicates, self.args)
+
+    def compile_fts(self, node):
+        if isinstance(node, Term):
+            return self.compile_term(node)
+
+        if isinstance(node, Phrase):
+            if node.field is not None:
+                # Column filters do not apply to phrases
+                return _group([self.compile_term(Term([x], field=node.field))
+                               for x in node.words])
+
+            return "\"{}\"".format(" ".join(node.words).lower())
+
+        if isinstance(node, Or):
+            children = list()
+
+            for child in node.children:
+                if isinstance(child, (Not, Filter)):
+                    raise QueryError("OR can only join words and phrases")
+
+                children.append(self.compile_fts(child))
+
+            return "({})".format(" OR ".join(children))
+
+        if isinstance(node, And):
+            positive = list()
+            negative = list()
+
+            for child in node.children:
+                if isinstance(child, Filter):
+                    raise QueryError("Field filters can't be grouped")
+
+                if isinstance(child, Not):
+                    negative.append(self.compile_fts(child.child))
+                else:
+                    positive.append(self.compile_fts(child))
+
+            if not positive:
+                raise QueryError("NOT needs a word to search for beside it")
+
+            expr = " AND ".join(positive)
+
+            for child in negative:
+                expr = "{} NOT {}".format(expr, child)
+
+            return "({})".format(expr)
+
+        if isinstance(node, Not):
+            raise QueryError("NOT needs a word to search for beside it")
+
+        raise QueryError("Field filters can't be grouped")
+
+    def compile_term(self, node):
+        words = [x.lower() for x in node.words]
+        star = "*" if node.prefix else ""
+
+        if node.field is not None:
+            items = ["{}:{}".format(node.field, x) for x in words]
+            items[-1] += star
+
+            return _group(items)
+
+        if len(words) == 1:
+            return words[0] + star
+
+        return "\"{}\"{}".format(" ".join(words), star)
+
+    def add_filter(self, node, negated):
+        if node.field == "from":
+            sql, args = self.compile_from(node.value)
+        elif node.field == "list":
+            sql, args = self.compile_list(node.value)
+        else:
+            sql, args = self.compile_date(node.value)
+
+        if negated:
+            sql = "not ({})".format(sql)
+
+        self.predicates.append(sql)
+        self.args.extend(args)
+
+    def compile_from(self, value):
+        if "@" in value:
+            return "m.from_address = ? collate nocase", [value]
+
+        pattern = "%{}%".format(_escape_like(value))
+
+        return ("(m.from_name like ? escape '\\' or m.from_address like ? escape '\\')",
+                [pattern, pattern])
+
+    def compile_list(self, value):
+        value = value.strip("<>")
+        pattern = "<{}%".format(_escape_like(value))
+
+        return "m.list_id like ? escape '\\'", [pattern]
+
+    def compile_date(self, value):
+        if ".." in value:
+            start, end = value.split("..", 1)
+        else:
+            start, end = value, value
+
+        predicates = list()
+        args = list()
+
+        if start:
+            predicates.append("m.date >= ?")
+            args.append(_parse_date(start)[0])
+
+        if end:
+            predicates.append("m.date < ?")
+            args.append(_parse_date(end)[1])
+
+        if not predicates:
+            raise QueryError("The date range '{}' has no ends".format(value))
+
+        return "({})".format(" and ".join(predicates)), args
+
+# A group ANDed at the top level, as in "(a list:dev) from:alice", is
+# the same as its clauses written out, so filters may appear inside it
+
+def _flatten(node):
+    if isinstance(node, And):
+        for child in node.children:
+            yield from _flatten(child)
+    else:
+        yield node
+
+# Parenthesize several items joined by AND, so that a NOT before them
+# applies to all of them
+
+def _group(items):
+    if len(items) == 1:
+        return items[0]
+
+    return "({})".format(" AND ".join(items))
+
+def _escape_like(value):
+    return value.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+
+# -> start, end of the year, month, or day in UTC seconds
+
+def _parse_date(value):
+    match = _date_re.match(value)
+
+    if match is None:
+        raise QueryError("Dates look like 2015, 2015-03, or 2015-03-01, not '{}'"
+                         .format(value))
+
+    year, month, day = match.groups()
+    year = int(year)
+
+    try:
+        if month is None:
+            start = year, 1, 1
+            end = year + 1, 1, 1
+        elif day is None:
+            month = int(month)
+            start = year, month, 1
+            end = (year + 1, 1, 1) if month == 12 else (year, month + 1, 1)
+        else:
+            start = year, int(month), int(day)
+            end = None
+
+        start_time = _timegm(start)
+    except ValueError:
+        raise QueryError("'{}' is not a valid date".format(value))
+
+    if end is None:
+        end_time = start_time + 86400
+    else:
+        end_time = _timegm(end)
+
+    return start_time, end_time
+
+def _timegm(date):
+    year, month, day = date
+
+    if not 1 <= day <= _calendar.monthrange(year, month)[1]:
+        raise ValueError()
+
+    return _calendar.timegm((year, month, day, 0, 0, 0))
@@ -21,8 +21,12 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
+import atexit as _atexit
 import collections as _collections
 import logging as _logging
+import logging.handlers as _logging_handlers
+import os as _os
+import queue as _queue
 import sys as _sys
 import threading as _threading
 
@@ -45,17 +49,23 @@ def _add_logging(name, level, file):
     assert level, level
     assert file, file
 
-    if isinstance(level, str):
-        level = _levels_by_name[level.lower()]
-
     if isinstance(file, str):
         file = open(file, "a")
 
-    handler = _logging.StreamHandler(file)
+    handler = _StreamHandler(file)
+
+    _add_handler(name, level, handler)
 
-    handler.setFormatter(_formatter)
+def _add_handler(name, level, handler, formatter=_formatter):
+    if isinstance(level, str):
+        level = _levels_by_name[level.lower()]
+
+    handler.setFormatter(formatter)
     handler.setLevel(level)
 
+    if _log_listener is not None:
+        handler = _QueueHandler(_log_listener.queue, handler)
+
     log = _logging.getLogger(name)
     log.setLevel(_logging.DEBUG)
     log.addHandler(handler)
@@ -92,6 +102,177 @@ def enable_file_logging(level, file):
         for name in _logged_modules:
             _add_logging(name, level, file)
 
+# Send the named logs to their own size-rotated file instead of the
+# module logs.  The logs share one handler, so they can safely use the
+# same file.  If format is set, it replaces the standard line format.
+
+def enable_rotating_file_logging(names, level, file, max_bytes=10 * 1024 * 1024,
+                                 backup_count=5, format=None):
+    assert file, file
+
+    handler = _RotatingFileHandler \
+        (file, maxBytes=max_bytes, backupCount=backup_count)
+
+    formatter = _formatter
+
+    if format is not None:
+        formatter = _logging.Formatter(format)
+
+    for name in names:
+        _remove_logging(name)
+        _add_handler(name, level, handler, formatter)
+
+        _logging.getLogger(name).propagate = False
+
+# Queued logging
+#
+# In queued mode, loggers get QueueHandlers that put records on a
+# bounded queue, and a QueueListener thread writes them out in batches,
+# flushing once per batch.  Logging calls never wait on a slow disk or
+# terminal.  If the queue is full, the record is dropped and counted.
+
+_log_listener = None
+_dropped_records = 0
+_dropped_records_lock = _threading.Lock()
+
+class _BatchedFlushMixin:
+    # When true, the queue listener flushes after each batch
+    batched = False
+
+    def flush(self):
+        if not self.batched:
+            super().flush()
+
+    def flush_batch(self):
+        super().flush()
+
+class _StreamHandler(_BatchedFlushMixin, _logging.StreamHandler):
+    pass
+
+class _RotatingFileHandler(_BatchedFlushMixin,
+                           _logging_handlers.RotatingFileHandler):
+    pass
+
+class _QueueHandler(_logging_handlers.QueueHandler):
+    def __init__(self, queue, target):
+        super().__init__(queue)
+
+        self.target = target
+        self.setLevel(target.level)
+
+        if isinstance(target, _BatchedFlushMixin):
+            target.batched = True
+
+    def enqueue(self, record):
+        global _dropped_records
+
+        try:
+            self.queue.put_nowait((self.target, record))
+        except _queue.Full:
+            with _dropped_records_lock:
+                _dropped_records += 1
+
+class _QueueListener(_logging_handlers.QueueListener):
+    def __init__(self, queue, batch_size):
+        super().__init__(queue)
+
+        self.batch_size = batch_size
+
+    def _monitor(self):
+        while True:
+            batch = [self.queue.get()]
+
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except _queue.Empty:
+                    break
+
+            targets = set()
+
+            for item in batch:
+                if item is self._sentinel:
+                    continue
+
+                target, record = item
+
+                target.handle(record)
+                targets.add(target)
+
+            for target in targets:
+                if isinstance(target, _BatchedFlushMixin):
+                    target.flush_batch()
+
+            if self._sentinel in batch:
+                break
+
+    def enqueue_sentinel(self):
+        self.queue.put(self._sentinel)
+
+def enable_queued_logging(max_records=10000, batch_size=100):
+    global _log_listener
+
+    if _log_listener is not None:
+        return
+
+    _log_listener = _QueueListener(_queue.Queue(max_records), batch_size)
+    _log_listener.start()
+
+    # Route the existing handlers through the queue
+
+    for log, handlers in _handlers_by_logger.items():
+        for i, handler in enumerate(handlers):
+            queue_handler = _QueueHandler(_log_listener.queue, handler)
+
+            log.removeHandler(handler)
+            log.addHandler(queue_handler)
+
+            handlers[i] = queue_handler
+
+def disable_queued_logging():
+    global _log_listener
+
+    if _log_listener is None:
+        return
+
+    _log_listener.stop()
+    _log_listener = None
+
+    for log, handlers in _handlers_by_logger.items():
+        for i, handler in enumerate(handlers):
+            if isinstance(handler, _QueueHandler):
+                log.removeHandler(handler)
+                log.addHandler(handler.target)
+
+                handlers[i] = handler.target
+
+                if isinstance(handler.target, _BatchedFlushMixin):
+                    handler.target.batched = False
+
+def get_dropped_record_count():
+    return _dropped_records
+
+def _restart_queued_logging():
+    # A forked child has the queue but not the listener thread, and
+    # the queue's lock may be held.  Start over with a fresh queue.
+
+    global _log_listener
+
+    if _log_listener is None:
+        return
+
+    _log_listener = _QueueListener(_queue.Queue(_log_listener.queue.maxsize),
+                                   _log_listener.batch_size)
+    _log_listener.start()
+
+    for handlers in _handlers_by_logger.values():
+        for handler in handlers:
+            if isinstance(handler, _QueueHandler):
+                handler.queue = _log_listener.queue
+
+_atexit.register(disable_queued_logging)
+_os.register_at_fork(after_in_child=_restart_queued_logging)
+
 def add_logged_module(name):
     assert isinstance(name, str), name
 